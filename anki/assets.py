@@ -0,0 +1,129 @@
+import os
+import re
+
+# clips synthesised into assets/ by older builds, referenced through the TTS text rather than a field
+_GENERATED_PATTERN = re.compile(r"tts_[0-9a-f]{32}\.ogg")
+
+
+class AssetIndex:
+    """
+    The files of a deck's assets folder, listed once. References such as
+    ``assets/01_une_chaise.jpg`` are resolved against this listing instead
+    of a stat per field.
+    """
+
+    def __init__(self, assets_path):
+
+        if not os.path.isdir(assets_path):
+            raise FileNotFoundError(f"{assets_path} is not a directory")
+
+        self._assets_path = assets_path
+        self._names = set()
+
+        for directory, directories, file_names in os.walk(assets_path):
+            directories[:] = [name for name in directories if not name.startswith(".")]
+            prefix = os.path.relpath(directory, assets_path).replace(os.sep, "/")
+            prefix = "" if prefix == "." else prefix + "/"
+            for file_name in file_names:
+                if not file_name.startswith(".") and not file_name.endswith(".tmp"):
+                    self._names.add(prefix + file_name)
+
+    def __contains__(self, name):
+        return name in self._names
+
+    def __iter__(self):
+        return iter(sorted(self._names))
+
+    def __len__(self):
+        return len(self._names)
+
+    def resolve(self, reference):
+        """
+        Returns the path of an ``assets/...`` reference, or None if there is
+        no such file.
+        """
+
+        if not reference.startswith("assets/") or reference[7:] not in self._names:
+            return None
+        return os.path.join(self._assets_path, reference[7:])
+
+
+class AssetReport:
+    """
+    Outcome of checking a deck's cards against its assets: ``missing`` and
+    ``unsupported_references`` list ``(card_number, field_name, reference)``
+    for references to files that don't exist or whose type the field can't
+    hold, ``unreferenced`` and ``unsupported_files`` list the asset files no
+    card uses and those that aren't a supported media type.
+    """
+
+    __slots__ = ('missing', 'unsupported_references', 'unreferenced', 'unsupported_files')
+
+    def __init__(self):
+        self.missing = []
+        self.unsupported_references = []
+        self.unreferenced = []
+        self.unsupported_files = []
+
+    @property
+    def ok(self) -> bool:
+        return not self.missing
+
+    @property
+    def clean(self) -> bool:
+        return not any(getattr(self, name) for name in self.__slots__)
+
+    def summary(self, deck_name, limit=10) -> str:
+
+        counts = [(len(self.missing), "missing"), (len(self.unsupported_references), "unsupported references"),
+                  (len(self.unreferenced), "unreferenced"), (len(self.unsupported_files), "unsupported files")]
+        lines = [f"{deck_name}: " + (", ".join(f"{count} {label}" for count, label in counts if count) or "assets ok")]
+
+        for label, references in (("missing", self.missing), ("unsupported", self.unsupported_references)):
+            for card_number, field_name, reference in references[:limit]:
+                lines.append(f"  {label}: card {card_number} {field_name} {reference}")
+            if len(references) > limit:
+                lines.append(f"  ... {len(references) - limit} more {label}")
+
+        for label, names in (("unreferenced", self.unreferenced), ("unsupported file", self.unsupported_files)):
+            for name in names[:limit]:
+                lines.append(f"  {label}: assets/{name}")
+            if len(names) > limit:
+                lines.append(f"  ... {len(names) - limit} more {label}")
+
+        return "\n".join(lines)
+
+
+def check_assets(cards, index, field_plan, supported_extensions) -> AssetReport:
+    """
+    Resolves every asset reference of ``cards`` against ``index``.
+    ``field_plan`` returns the ``FieldPlan`` of a card, which tells the file
+    types each field converts.
+    """
+
+    report = AssetReport()
+    referenced = set()
+
+    for card_number, card in enumerate(cards, 1):
+        for field_name, extensions in field_plan(card).fields:
+            reference = card[field_name]
+            if not isinstance(reference, str) or not reference.startswith("assets/"):
+                continue
+
+            if reference[7:] in index:
+                referenced.add(reference[7:])
+
+            if reference[reference.rfind("."):] not in extensions:
+                report.unsupported_references.append((card_number, field_name, reference))
+            elif reference[7:] not in index:
+                report.missing.append((card_number, field_name, reference))
+
+    for name in index:
+        if name in referenced or _GENERATED_PATTERN.fullmatch(os.path.basename(name)):
+            continue
+        if os.path.splitext(name)[1] in supported_extensions:
+            report.unreferenced.append(name)
+        else:
+            report.unsupported_files.append(name)
+
+    return report
@@ -0,0 +1,199 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024 * 1024
+DEFAULT_EVICTION_GRACE = 600
+
+
+def file_digest(file_path, chunk_size=1024 * 1024) -> str:
+
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+_digests = {}
+
+
+def source_digest(source_path) -> str:
+    """
+    file_digest memoised on (path, size, mtime), so a file is only read once
+    per process while it is unchanged.
+    """
+
+    stat = os.stat(source_path)
+    memo_key = (os.path.realpath(source_path), stat.st_size, stat.st_mtime_ns)
+    digest = _digests.get(memo_key)
+    if digest is None:
+        digest = file_digest(source_path)
+        _digests[memo_key] = digest
+    return digest
+
+
+class ConversionCache:
+    """
+    Persistent on-disk cache of converted media, keyed by the sha256 of the
+    source file plus the target extension and encoder settings.
+
+    Payloads live in ``<cache_path>/<key[:2]>/<key><ext>`` and an sqlite index
+    tracks their size and last use, which drives LRU eviction once the cache
+    grows past ``max_bytes``. Payloads are written to a unique temporary name
+    and renamed into place, so several deck builds can share one cache.
+    Entries used in the last ``grace`` seconds are never evicted, so a build
+    doesn't lose the payloads it just got or wrote to another build.
+    """
+
+    def __init__(self, cache_path, max_bytes=None, grace=DEFAULT_EVICTION_GRACE):
+
+        if cache_path is None:
+            raise ValueError("cache_path is required")
+
+        if max_bytes is None:
+            max_bytes = int(os.environ.get("FANKI_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES))
+
+        self._cache_path = cache_path
+        self._max_bytes = max_bytes
+        self._grace = grace
+        self._index_path = os.path.join(cache_path, "index.sqlite")
+        self._local = threading.local()
+
+        if not os.path.isdir(self._cache_path):
+            os.makedirs(self._cache_path, exist_ok=True)
+
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, "
+                "path TEXT NOT NULL, "
+                "size INTEGER NOT NULL, "
+                "last_used REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+
+    def _connection(self) -> sqlite3.Connection:
+
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._index_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def key(self, source_path, extension, settings=None) -> str:
+
+        payload = json.dumps({
+            'source': source_digest(source_path),
+            'extension': extension,
+            'settings': settings or {},
+        }, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _payload_path(self, key, extension):
+        return os.path.join(self._cache_path, key[:2], key + extension)
+
+    def get(self, key):
+
+        with self._connection() as conn:
+            row = conn.execute("SELECT path FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+
+            payload_path = os.path.join(self._cache_path, row[0])
+            if not os.path.isfile(payload_path):
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                return None
+
+            conn.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+            return payload_path
+
+    def put(self, key, extension, encoder, source_path):
+        """
+        Run ``encoder(source_path, destination_path)`` into a temporary file
+        and publish the result under ``key``. Returns the cached payload path.
+        """
+
+        payload_path = self._payload_path(key, extension)
+        os.makedirs(os.path.dirname(payload_path), exist_ok=True)
+
+        tmp_path = f"{payload_path}.{uuid.uuid4().hex}.tmp{extension}"
+        try:
+            encoder(source_path, tmp_path)
+            os.replace(tmp_path, payload_path)
+        finally:
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO entries (key, path, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, os.path.relpath(payload_path, self._cache_path), os.path.getsize(payload_path), time.time())
+            )
+
+        self.evict(keep=key)
+        return payload_path
+
+    def put_bytes(self, key, extension, data):
+        """
+        Publish an in-memory payload under ``key``. Returns its path.
+        """
+
+        def write(_source_path, destination_path):
+            with open(destination_path, 'wb') as file:
+                file.write(data)
+
+        return self.put(key, extension, write, None)
+
+    def convert(self, source_path, extension, encoder, settings=None):
+        """
+        Return the path of ``source_path`` converted to ``extension``, running
+        ``encoder`` only on a cache miss.
+        """
+
+        key = self.key(source_path, extension, settings)
+        payload_path = self.get(key)
+        if payload_path is not None:
+            return payload_path
+        return self.put(key, extension, encoder, source_path)
+
+    def stats(self) -> dict:
+
+        with self._connection() as conn:
+            entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+
+        return {'path': self._cache_path, 'entries': entries, 'bytes': size, 'max_bytes': self._max_bytes}
+
+    def evict(self, max_bytes=None, keep=None):
+        """
+        Removes the least recently used entries until the cache fits in
+        ``max_bytes``, leaving out ``keep`` and the entries still in their
+        grace period.
+        """
+
+        if max_bytes is None:
+            max_bytes = self._max_bytes
+
+        conn = self._connection()
+        with conn:
+            # BEGIN IMMEDIATE takes the write lock so two builds don't evict the same rows
+            conn.execute("BEGIN IMMEDIATE")
+            total, = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()
+            if total <= max_bytes:
+                return
+
+            candidates = conn.execute("SELECT key, path, size FROM entries WHERE last_used < ? AND key IS NOT ? ORDER BY last_used",
+                                      (time.time() - self._grace, keep)).fetchall()
+            for key, path, size in candidates:
+                if total <= max_bytes:
+                    break
+                payload_path = os.path.join(self._cache_path, path)
+                if os.path.isfile(payload_path):
+                    os.remove(payload_path)
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                total -= size
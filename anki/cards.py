@@ -0,0 +1,67 @@
+import sys
+
+
+class CardStore:
+    """
+    Column-oriented store for the cards of a deck built in memory: one list
+    of values per field, indexed by card. A column is only allocated once a
+    card sets that field, so fields no card uses (most of the optional ones)
+    cost nothing. Cards are handed out as fresh dicts with every field while
+    iterating, so only the cards being processed exist as dicts and
+    consumers can't change the stored values.
+
+    The field names are taken from the first card appended.
+    """
+
+    __slots__ = ('_field_names', '_columns', '_count')
+
+    def __init__(self, field_names=None):
+        self._field_names = None
+        self._columns = None
+        self._count = 0
+        if field_names is not None:
+            self._set_fields(field_names)
+
+    def _set_fields(self, field_names):
+        self._field_names = tuple(sys.intern(field_name) for field_name in field_names)
+        self._columns = [None] * len(self._field_names)
+
+    @property
+    def field_names(self):
+        return self._field_names
+
+    def append(self, card):
+
+        if self._field_names is None:
+            self._set_fields(card)
+        elif len(card) != len(self._field_names) or any(field_name not in card for field_name in self._field_names):
+            raise ValueError("card fields don't match the fields of the store")
+
+        columns = self._columns
+        for position, field_name in enumerate(self._field_names):
+            value = card[field_name]
+            column = columns[position]
+            if column is not None:
+                column.append(value)
+            elif value is not None:
+                columns[position] = [None] * self._count + [value]
+        self._count += 1
+
+    def __getitem__(self, index):
+
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("card index out of range")
+
+        return self._row(index)
+
+    def _row(self, index) -> dict:
+        return {field_name: column[index] if column is not None else None for field_name, column in zip(self._field_names, self._columns)}
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        for index in range(self._count):
+            yield self._row(index)
@@ -1,14 +1,72 @@
+import functools
 import hashlib
 import inspect
 import json
 import os
+import io
+import threading
+import time
+from collections import deque
 from abc import abstractmethod
-import genanki
-from PIL import Image
-from pydub import AudioSegment
-from moviepy.editor import VideoFileClip
-from anki.utilities import text_to_ogg
-from bs4 import BeautifulSoup
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import TYPE_CHECKING
+from anki.assets import AssetIndex, AssetReport, check_assets
+from anki.cache import ConversionCache, source_digest
+from anki.cards import CardStore
+from anki.ffmpeg import probe, run_ffmpeg, trailing_silence
+from anki.manifest import BuildManifest, json_digest
+from anki.package import PackageWriter
+from anki.presets import AudioPreset, ImagePreset, VideoPreset, resolve_audio_preset, resolve_image_preset, resolve_video_preset
+from anki.profiling import BuildProfile, NullProfile
+from anki.sharding import ShardedPackageWriter, resolve_shard_policy
+from anki.staging import MediaItem, MediaRegistry, MediaStage
+from anki.stream import CardStream, iter_deck_cards, iter_jsonl_cards, read_deck_header
+from anki.tts import get_engine
+
+# optional entry of a card in data.json that identifies its note across builds
+NOTE_KEY_FIELD = 'key'
+
+# genanki, Pillow and BeautifulSoup are imported where they are
+# first used, so decks without video, audio or HTML never pay for loading them
+if TYPE_CHECKING:
+    import genanki
+
+
+class FieldPlan:
+    """
+    How the cards of one field layout are processed, decided once from the
+    field names: ``fields`` lists ``(field_name, extensions)`` for every field
+    that may hold an asset, where ``extensions`` maps the file extensions the
+    field converts to their media kind; ``tts`` lists ``(field_name,
+    field_name_base, field_name_audio)`` for every ``_tts`` field, which run
+    after the others so they see the converted values.
+    """
+
+    __slots__ = ('fields', 'tts')
+
+    def __init__(self, field_names, media_extensions):
+
+        # every field converts images, _audio and _video fields also convert their own kind
+        roles = {
+            'text': ('image',),
+            'audio': ('image', 'audio'),
+            'video': ('image', 'video'),
+        }
+
+        self.fields = []
+        self.tts = []
+        for field_name in field_names:
+            if field_name == NOTE_KEY_FIELD:
+                continue
+
+            if field_name.endswith("_tts"):
+                field_name_base = field_name[:-4]
+                self.tts.append((field_name, field_name_base, field_name_base + "_audio"))
+                continue
+
+            role = 'audio' if field_name.endswith("_audio") else 'video' if field_name.endswith("_video") else 'text'
+            extensions = {extension: kind for kind in roles[role] for extension in media_extensions[kind]}
+            self.fields.append((field_name, extensions))
 
 
 class FankiModel:
@@ -20,6 +78,7 @@ class FankiModel:
         self.templates = []
         self.css = ""
         self._root_path = None
+        self._plans = {}
 
     def add_field(self, name):
         self.fields.append({'name': name})
@@ -27,6 +86,17 @@ class FankiModel:
     def get_fields(self):
         return self.fields
 
+    def field_plan(self, field_names, media_extensions) -> FieldPlan:
+        """
+        Returns the compiled plan for cards with the ``field_names`` keys,
+        in order. Plans are built once per layout.
+        """
+
+        plan = self._plans.get(field_names)
+        if plan is None:
+            plan = self._plans[field_names] = FieldPlan(field_names, media_extensions)
+        return plan
+
     def add_template(self, name, question_format, answer_format):
         self.templates.append({
             'name': name,
@@ -46,12 +116,35 @@ class FankiModel:
         return self.css
 
     def get_model(self):
+        import genanki
 
         return genanki.Model(self.id, self.name, fields=self.get_fields(), templates=self.get_templates(), css=self.get_css())
 
 
 
 
+def _ordered_map(executor, fn, iterable, window):
+
+    # like executor.map, but only keeps `window` items in flight instead of
+    # submitting the whole iterable up front
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
+
+
+def _rename_media_reference(field_value, old_name, new_name):
+
+    if field_value == old_name:
+        return new_name
+
+    return field_value.replace(f'src="{old_name}"', f'src="{new_name}"').replace(f"[sound:{old_name}]", f"[sound:{new_name}]")
+
+
 def _get_real_file_path(file_path):
     __dir__ = os.path.dirname(os.path.realpath(__file__))
     return os.path.join(__dir__, "models", file_path)
@@ -67,20 +160,86 @@ def _get_file_content(file_path) ->str:
     else:
         return ""
 
+def _encode_webp(source_path, destination_path, preset=None):
+    from PIL import Image, ImageOps
+
+    if preset is None:
+        preset = ImagePreset()
+
+    image = Image.open(source_path)
+
+    if not preset.fits(image.size):
+        max_size = preset.max_size
+        # orientations 5 to 8 swap width and height once transposed
+        if preset.exif_transpose and image.getexif().get(0x0112, 1) in (5, 6, 7, 8):
+            max_size = max_size[::-1]
+        # JPEGs are decoded at 1/2, 1/4 or 1/8 scale when that still covers the box
+        image.draft(None, max_size)
+
+    if preset.exif_transpose:
+        image = ImageOps.exif_transpose(image)
+
+    if preset.max_size is not None:
+        image.thumbnail(preset.max_size, Image.Resampling.LANCZOS)
+
+    image.save(destination_path, 'webp', quality=preset.quality, method=preset.method, lossless=preset.lossless)
+
+
+def _encode_ogg(source_path, destination_path, preset=None):
+
+    if preset is None:
+        preset = AudioPreset()
+
+    end = trailing_silence(source_path, preset.silence_threshold) if preset.trim_silence else None
+
+    # ffmpeg streams the source to the encoder, the decoded PCM is never held in memory
+    if isinstance(destination_path, str):
+        run_ffmpeg(["-i", source_path, *preset.ffmpeg_arguments(end), destination_path])
+    else:
+        run_ffmpeg(["-i", source_path, *preset.ffmpeg_arguments(end), "pipe:1"], destination=destination_path)
+
+
+def _encode_mp4(source_path, destination_path, preset=None):
+
+    if preset is None:
+        preset = VideoPreset()
+
+    # H.264/AAC sources only need a new container, the rest is re-encoded
+    run_ffmpeg(["-i", source_path, *preset.ffmpeg_arguments(probe(source_path)), destination_path])
+
+
+def _encode_to_bytes(encoder, source_path) -> bytes:
+
+    # Pillow and _encode_ogg both accept a file object as destination
+    buffer = io.BytesIO()
+    encoder(source_path, buffer)
+    return buffer.getvalue()
+
+
+STREAM_THRESHOLD = 16 * 1024 * 1024
+
+
 class FankiModelGeneric:
 
-    def __init__(self, deck_id=None, deck_name=None, deck_namespace=None, deck_alias=None, root_path=None):
+    # preset names, dicts of options or preset instances; data.json's image_preset, audio_preset and video_preset override them
+    image_preset = None
+    audio_preset = None
+    video_preset = None
+
+    # a card count or a dict of ShardPolicy options; data.json's shards overrides it
+    shards = None
 
-        caller_file_path = inspect.stack()[1].filename
-        caller_dir_path = os.path.dirname(os.path.realpath(caller_file_path))
+    def __init__(self, deck_id=None, deck_name=None, deck_namespace=None, deck_alias=None, root_path=None, image_preset=None, audio_preset=None, video_preset=None, shards=None):
 
         if root_path is None or not os.path.isdir(root_path):
-            root_path = caller_dir_path
+            caller_file_path = inspect.stack()[1].filename
+            root_path = os.path.dirname(os.path.realpath(caller_file_path))
 
         self._valid_audio_files = [".mp3", ".ogg", ".wav", ".flac", ".m4a"]
         self._valid_image_files = [".jpg", ".png", ".gif", ".tiff", ".svg", ".tif", ".jpeg", ".webp"]
         self._valid_video_files = [".avi", ".ogv", ".mpg", ".mpeg", ".mov", ".mp4", ".mkv", ".flv", ".swf"]
         self._valid_any_files = self._valid_audio_files + self._valid_image_files + self._valid_video_files
+        self._media_extensions = {'image': self._valid_image_files, 'audio': self._valid_audio_files, 'video': self._valid_video_files}
 
         self._root_path = root_path
         self._path_assets = os.path.join(self._root_path, "assets")
@@ -96,6 +255,11 @@ class FankiModelGeneric:
         self._deck_name = deck_name
         self._deck_alias = deck_alias
         self._deck_namespace = deck_namespace
+        self._image_preset = resolve_image_preset(image_preset if image_preset is not None else self.image_preset)
+        self._audio_preset = resolve_audio_preset(audio_preset if audio_preset is not None else self.audio_preset)
+        self._video_preset = resolve_video_preset(video_preset if video_preset is not None else self.video_preset)
+        self._shards = resolve_shard_policy(shards if shards is not None else self.shards)
+        self._card_key_settings = {'image_preset': self._image_preset.to_json(), 'audio_preset': self._audio_preset.to_json(), 'video_preset': self._video_preset.to_json()}
 
         if self._deck_id is None or not isinstance(self._deck_id, int) or self._deck_id < 0:
             raise ValueError("deck_id is required")
@@ -110,8 +274,9 @@ class FankiModelGeneric:
             raise ValueError("deck_namespace is required")
 
 
-        self._packages_path = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "packages")
-        self._temp_path = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "temp")
+        # FANKI_PACKAGES_PATH and FANKI_TEMP_PATH move the outputs and the scratch files out of the repository
+        self._packages_path = os.environ.get("FANKI_PACKAGES_PATH") or os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "packages")
+        self._temp_path = os.environ.get("FANKI_TEMP_PATH") or os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "temp")
 
         if not os.path.isdir(self._packages_path):
             raise FileNotFoundError(f"_packages_path folder ({self._packages_path}) not found")
@@ -119,8 +284,20 @@ class FankiModelGeneric:
         if not os.path.isdir(self._temp_path):
             raise FileNotFoundError(f"_temp_path folder ({self._temp_path}) not found")
 
-        self._deck_cards = []
+        self._cache = ConversionCache(os.path.join(self._temp_path, "cache")) if os.environ.get("FANKI_CACHE", "1") != "0" else None
+        self._stage = MediaStage(os.path.join(self._temp_path, self._deck_namespace + "." + self._deck_alias))
+        self._tts = get_engine()
+        self._card_key_settings['tts'] = self._tts.settings()
+        self._deck_cards = CardStore()
         self._deck_media = []
+        self._process_pool = None
+        self._manifest = None
+        self._converted = {}
+        self._path_locks = {}
+        self._path_locks_lock = threading.Lock()
+        self._profile = NullProfile()
+        self._import_stats = None
+        self._asset_index = None
         self._f_model = self._f_model_instance()
         self._setup()
 
@@ -139,88 +316,299 @@ class FankiModelGeneric:
 
         pass
 
-    def _get_model_instance(self) -> genanki.Model:
+    @abstractmethod
+    def _card_from_data(self, card) -> dict:
+
+        pass
+
+    def import_card_stream(self, cards_factory):
+        """
+        Use a lazily read card source instead of a list: ``cards_factory``
+        returns a fresh iterator of raw card dicts on each call.
+        """
+
+        self._deck_cards = CardStream(lambda: (self._card_from_data(card) for card in cards_factory()))
+
+    def get_model_fields(self):
+        return [field['name'] for field in self._f_model.get_fields()]
+
+    def _get_model_instance(self) -> "genanki.Model":
 
         return self._f_model.get_model()
 
-    def _get_deck_instance(self) -> genanki.Deck:
+    def _get_deck_instance(self, jobs=None, process_pool=None) -> "genanki.Deck":
+        import genanki
 
         model = self._get_model_instance()
         deck = genanki.Deck(self._deck_id, self._deck_name)
 
-        model_fields = [field['name'] for field in self._f_model.get_fields()]
+        for note, media in self._iter_notes(model, jobs, process_pool):
+            self._deck_media.extend(media)
+            deck.add_note(note)
+
+        return deck
 
+    def _iter_notes(self, model, jobs=None, process_pool=None, shared_media=False, thread_pool=None):
+        import genanki
+
+        model_fields = self.get_model_fields()
+        registry = MediaRegistry(self._deck_namespace if shared_media else None)
+        # counted in the build manifest when there is one, so a large deck
+        # doesn't keep every key in memory
+        occurrences = self._manifest.occurrences() if self._manifest is not None else {}
+
+        for card, media in self._parse_cards(jobs, process_pool, thread_pool):
+
+            # resolved here, in card order, so the canonical name of a payload
+            # doesn't depend on which worker finished first
+            media = self._canonical_media(registry, card, media)
+
+            with self._profile.stage("note_creation"):
+                fields = [card.get(field_name) if card.get(field_name) is not None else "" for field_name in model_fields]
+                note = genanki.Note(model=model, fields=fields, guid=self._note_guid(occurrences, card[NOTE_KEY_FIELD], fields))
+
+            yield note, media
+
+    def _note_key(self, card) -> str:
+        """
+        What identifies a card's note when data.json doesn't give it a key:
+        the raw value of its first field, the one Anki checks for duplicates.
+        """
+
+        value = card.get(self._f_model.get_fields()[0]['name'])
+        if value is None or value == "":
+            return json_digest(card)
+        return str(value)
+
+    def _note_guid(self, occurrences, key, fields) -> str:
+        import genanki
+
+        # cards sharing a key are told apart by their order among themselves
+        occurrence = occurrences.get(key, 0)
+        occurrences[key] = occurrence + 1
+        if occurrence == 0:
+            guid = genanki.guid_for(self._deck_id, key)
+        else:
+            guid = genanki.guid_for(self._deck_id, key, occurrence)
+
+        if self._manifest is None:
+            return guid
+
+        # notes of a package built before GUIDs were keyed have genanki's
+        # default one, a hash of their fields; they keep it from then on, or
+        # the first import after the upgrade would duplicate all of them
+        return self._manifest.kept_guid(guid, lambda: genanki.guid_for(*fields))
+
+    def _canonical_media(self, registry, card, media):
+
+        canonical_media = []
+        for item in media:
+            canonical = registry.canonical(item)
+            if canonical.name != item.name:
+                for field_name, field_value in card.items():
+                    if isinstance(field_value, str) and field_name != NOTE_KEY_FIELD:
+                        card[field_name] = _rename_media_reference(field_value, item.name, canonical.name)
+            canonical_media.append(canonical)
+        return canonical_media
+
+    def _parse_cards(self, jobs=None, process_pool=None, thread_pool=None):
+
+        self._prefetch_tts()
+
+        if jobs is None or jobs <= 1:
+            yield from map(self._parse_card, self._deck_cards)
+            return
+
+        if process_pool is None:
+            with ProcessPoolExecutor(max_workers=jobs) as process_pool:
+                yield from self._parse_cards(jobs, process_pool, thread_pool)
+            return
+
+        # conversions run in worker processes, while the threads mostly wait on
+        # them or on TTS round-trips; results come back in card order
+        if thread_pool is None:
+            with ThreadPoolExecutor(max_workers=jobs * 4) as thread_pool:
+                yield from self._parse_cards(jobs, process_pool, thread_pool)
+            return
+
+        self._process_pool = process_pool
+        try:
+            yield from _ordered_map(thread_pool, self._parse_card, self._deck_cards, jobs * 16)
+        finally:
+            self._process_pool = None
+
+    def _parse_card(self, card):
+
+        if self._manifest is None:
+            media = []
+            return self._parse_card_fields(card, media), media
+
+        card_key = self._card_key(card)
+        entry = self._manifest.get_card(card_key)
+
+        # a hit is a card reused from the previous build
+        with self._profile.stage("parse_card") as timer:
+            timer.hit = entry is not None
+            if entry is not None:
+                media = [MediaItem.from_json(item) for item in entry['media']]
+                for item in media:
+                    item.rebuild = functools.partial(self._reparsed_media, card, item.name)
+                card = entry['card']
+            else:
+                media = []
+                card = self._parse_card_fields(card, media)
+
+        self._manifest.put_card(card_key, card, [item.to_json() for item in media])
+        return card, media
+
+    def _reparsed_media(self, card, name) -> MediaItem:
+
+        # the payload of a reused card was evicted from the cache since
+        media = []
+        self._parse_card_fields(dict(card), media)
+        return next(item for item in media if item.name == name)
+
+    def _card_assets(self, card) -> dict:
+
+        assets = {}
+        for field_value in card.values():
+            if isinstance(field_value, str) and field_value.startswith("assets/"):
+                asset_path = self._asset_exists(field_value)
+                if asset_path is not None:
+                    assets[field_value] = source_digest(asset_path)
+        return assets
+
+    def _card_key(self, card) -> str:
+        return json_digest({'card': card, 'assets': self._card_assets(card), **self._card_key_settings})
+
+    def _source_date(self) -> int:
+        """
+        Timestamp the packages are written with. It is SOURCE_DATE_EPOCH when
+        set, otherwise the last change to the deck's data or assets. Rebuilding
+        the same sources gives the same bytes. An edit still gives the notes
+        a newer modification time, which Anki needs to update them on import.
+        """
+
+        source_date_epoch = os.environ.get("SOURCE_DATE_EPOCH")
+        if source_date_epoch:
+            return int(source_date_epoch)
+
+        paths = [os.path.join(self._root_path, file_name) for file_name in ("data.json", "cards.jsonl")]
+        paths += [self._asset_index.resolve("assets/" + name) for name in self._asset_index]
+        return int(max((os.stat(path).st_mtime for path in paths if os.path.isfile(path)), default=0))
+
+    def _build_inputs(self) -> dict:
+
+        data = {}
+        for file_name in ("data.json", "cards.jsonl"):
+            data_file_path = os.path.join(self._root_path, file_name)
+            if os.path.isfile(data_file_path):
+                data[file_name] = source_digest(data_file_path)
+
+        assets = {}
+        card_keys = hashlib.sha256()
         for card in self._deck_cards:
-            card = self._parse_card_fields(card)
+            assets.update(self._card_assets(card))
+            card_keys.update(self._card_key(card).encode())
 
-            fields = [card.get(field_name) if card.get(field_name) is not None else "" for field_name in model_fields]
-            print(fields)
+        return {
+            'data': data,
+            'deck': [self._deck_id, self._deck_name],
+            'model': json_digest([self._f_model.id, self._f_model.name, self.get_model_fields(), self._f_model.get_templates(), self._f_model.get_css()]),
+            'assets': assets,
+            'cards': card_keys.hexdigest(),
+        }
 
+    def _field_plan(self, card) -> FieldPlan:
+        return self._f_model.field_plan(tuple(card), self._media_extensions)
 
-            note = genanki.Note(model=model, fields=fields)
-            deck.add_note(note)
+    def _parse_card_fields(self, card, media) -> dict:
+        """
+        Returns the parsed fields of ``card`` as a new row, leaving the card
+        as it is.
+        """
 
-        return deck
-
-    def _parse_card_fields(self, card) -> dict:
+        plan = self._field_plan(card)
+        row = dict(card)
 
         # special fields
-        for field_name, field_value in card.items():
-            card[field_name] = self._parse_field_value(field_name, field_value)
+        for field_name, extensions in plan.fields:
+            with self._profile.stage("parse_field_value"):
+                row[field_name] = self._parse_field_value(card[field_name], extensions, media)
 
-        # tts fields
-        for field_name, field_value in card.items():
-            card[field_name] = self._parse_field_value_tts(card, field_name, field_value)
+        # tts fields, which see the parsed values of the others
+        for field_name, field_name_base, field_name_audio in plan.tts:
+            with self._profile.stage("parse_field_value_tts"):
+                self._parse_field_value_tts(row, field_name, field_name_base, field_name_audio, media)
+            row[field_name] = ""
 
-        for field_name, field_value in card.items():
-            if not isinstance(field_value, str):
-                card[field_name] = ""
+        if row.get(NOTE_KEY_FIELD) is None:
+            row[NOTE_KEY_FIELD] = self._note_key(card)
 
-        return card
+        return row
 
 
-    def _parse_field_value(self, field_name, field_value) -> str:
-
-        if field_name.endswith("_tts"):
-            return field_value
+    def _parse_field_value(self, field_value, extensions, media) -> str:
 
-        if field_value is None:
+        if not isinstance(field_value, str):
             return ""
 
+        kind = extensions.get(field_value[field_value.rfind("."):])
+        if kind is None or not field_value.startswith("assets/"):
+            return field_value
 
-        is_image = any([field_value.endswith(valid_file) for valid_file in self._valid_image_files])
-        is_audio = any([field_value.endswith(valid_file) for valid_file in self._valid_audio_files])
-        is_video = any([field_value.endswith(valid_file) for valid_file in self._valid_video_files])
-        is_file = any([field_value.endswith(valid_file) for valid_file in self._valid_any_files])
         asset_path = self._asset_exists(field_value)
-
-        if not is_file or not field_value.startswith("assets/") or self._root_path is None or asset_path is None:
+        if asset_path is None:
             return field_value
 
-        if is_audio and field_name.endswith("_audio"):
-            file_path = self._convert_to_ogg(asset_path)
-            self._deck_media.append(file_path)
-            return "[sound:{}]".format(os.path.basename(file_path))
+        if kind == 'audio':
+            item = self._convert_to_ogg(asset_path)
+            media.append(item)
+            return "[sound:{}]".format(item.name)
 
-        if is_video and field_name.endswith("_video"):
-            file_path = self._convert_to_mp4(asset_path)
-            self._deck_media.append(file_path)
-            return os.path.basename(file_path)
+        if kind == 'video':
+            item = self._convert_to_mp4(asset_path)
+            media.append(item)
+            return item.name
 
-        if is_image:
-            file_path = self._convert_to_webp(asset_path)
-            self._deck_media.append(file_path)
-            return '<img src="' + os.path.basename(file_path) + '">'
+        item = self._convert_to_webp(asset_path)
+        media.append(item)
+        return '<img src="' + item.name + '">'
 
-        return field_value
+    def prewarm_tts(self) -> int:
+        """
+        Synthesises every TTS clip the deck is missing ahead of a build and
+        waits for them. Returns how many were requested.
+        """
 
-    def _parse_field_value_tts(self, card, field_name, field_value):
+        futures = self._prefetch_tts()
+        for future in futures:
+            future.result()
+        return len(futures)
 
-        if not field_name.endswith("_tts"):
-            return field_value
+    def _prefetch_tts(self):
+
+        # queue every missing TTS clip up front so the engine can work through
+        # them concurrently while the cards are parsed
+        futures = []
+        for card in self._deck_cards:
+            for field_name, field_name_base, field_name_audio in self._field_plan(card).tts:
+
+                field_value_base = card.get(field_name_base)
+                if isinstance(field_value_base, str) and field_value_base.startswith("assets/"):
+                    continue
 
-        field_name_base = field_name[:-4]
-        field_name_audio = field_name_base + "_audio"
+                text = self._tts_text(card, field_name_base, field_name_audio, card[field_name])
+                if text is None:
+                    continue
+
+                file_path = self._tts_file_path(text)
+                if not os.path.isfile(file_path) and self._tts.cached(text, prosody='slow') is None:
+                    futures.append(self._tts.submit(text, None if self._tts.cache is not None else file_path, prosody='slow'))
+
+        return futures
+
+    def _tts_text(self, card, field_name_base, field_name_audio, field_value):
 
         if card.get(field_name_audio):
             return None
@@ -233,81 +621,158 @@ class FankiModelGeneric:
             field_value = card.get(field_name_base)
 
             if "<" in field_value:
+                from bs4 import BeautifulSoup
+
                 field_value = BeautifulSoup(field_value, "html.parser").get_text()
 
         if not isinstance(field_value, str) or field_value == "":
             return None
 
-        # md5 field_value as string
-        md5 = hashlib.md5(field_value.encode()).hexdigest()
+        return field_value
+
+    def _tts_file_path(self, text):
+
+        # clips used to be stored next to the deck's assets; the ones already
+        # there are still packaged as they are, new ones go to the shared cache
+        md5 = hashlib.md5(text.encode()).hexdigest()
         file_name = f"tts_{md5}.ogg"
-        file_path = os.path.join(self._path_assets, file_name)
+        return os.path.join(self._path_assets, file_name)
 
-        if not os.path.isfile(file_path):
-            file_path = text_to_ogg(text=field_value, destination_path=file_path, prosody='slow')
-            print(file_path)
+    def _parse_field_value_tts(self, card, field_name, field_name_base, field_name_audio, media):
 
-        if not os.path.isfile(file_path):
-            return None
+        field_value = self._tts_text(card, field_name_base, field_name_audio, card[field_name])
+        if field_value is None:
+            return
+
+        file_path = self._tts_file_path(field_value)
+        name = os.path.basename(file_path)
+
+        with self._path_lock(file_path), self._profile.stage("tts") as timer:
+            if not os.path.isfile(file_path):
+                cached_path = self._tts.cached(field_value, prosody='slow')
+                timer.hit = cached_path is not None
+                if cached_path is not None:
+                    file_path = cached_path
+                else:
+                    file_path = self._tts.synthesize(text=field_value, destination_path=None if self._tts.cache is not None else file_path, prosody='slow')
+            else:
+                timer.hit = True
 
-        self._deck_media.append(file_path)
+        if not os.path.isfile(file_path):
+            return
 
-        card[field_name_audio] = "[sound:{}]".format(os.path.basename(file_path))
+        rebuild = functools.partial(self._resynthesized, field_value, name) if self._tts.cache is not None else None
+        item = self._stage.reference(file_path, name, rebuild)
+        media.append(item)
 
-        return None
+        card[field_name_audio] = "[sound:{}]".format(item.name)
 
-    def _copy_asset(self, _asset_path):
+    def _resynthesized(self, text, name) -> MediaItem:
 
-        if not os.path.isfile(_asset_path):
-            raise FileNotFoundError("{} is not a file", _asset_path)
+        # the clip was evicted from the TTS cache after it was looked up
+        return self._stage.reference(self._tts.synthesize(text=text, prosody='slow'), name)
 
-        temp_file_path = self._temp_asset_path(_asset_path)
-        os.system(f"cp {_asset_path} {temp_file_path}")
-        return temp_file_path
+    def _pass_through_asset(self, _asset_path):
 
-    def _temp_asset_path(self, _asset_path):
-        return self._asset_temp_path(self._asset_final_name(_asset_path))
+        # already in the right format: packaged straight from the deck's assets folder
+        return self._stage.reference(_asset_path, os.path.basename(self._asset_final_name(_asset_path)))
 
     def _convert_to_webp(self, asset_path):
 
-        if asset_path.endswith(".webp"):
-            return self._copy_asset(asset_path)
+        preset = self._image_preset
+        if asset_path.endswith(".webp") and (preset.max_size is None or self._image_fits(asset_path)):
+            return self._pass_through_asset(asset_path)
 
-        temp_file_path = self._temp_asset_path(asset_path)
+        return self._convert_cached(asset_path, ".webp", functools.partial(_encode_webp, preset=preset), {'format': 'webp', **preset.to_json()}, buffered=True)
 
-        temp_file_path = os.path.splitext(temp_file_path)[0] + ".webp"
+    def _image_fits(self, asset_path) -> bool:
+        from PIL import Image
 
-        image = Image.open(asset_path)
-        image.save(temp_file_path, 'webp')
-        return temp_file_path
+        # only the header is read
+        with Image.open(asset_path) as image:
+            return self._image_preset.fits(image.size)
 
     def _convert_to_ogg(self, asset_path):
 
-        if asset_path.endswith(".ogg"):
-            return self._copy_asset(asset_path)
+        preset = self._audio_preset
+        if asset_path.endswith(".ogg") and preset.keeps_ogg():
+            return self._pass_through_asset(asset_path)
 
-        temp_file_path = self._temp_asset_path(asset_path)
-        temp_file_path = os.path.splitext(temp_file_path)[0] + ".ogg"
-
-        audio = AudioSegment.from_file(asset_path)
-        audio.export(temp_file_path, format="ogg")
-        return temp_file_path
+        return self._convert_cached(asset_path, ".ogg", functools.partial(_encode_ogg, preset=preset), {'format': 'ogg', **preset.to_json()}, buffered=True)
 
     def _convert_to_mp4(self, asset_path):
 
-        if asset_path.endswith(".mp4"):
-            return self._copy_asset(asset_path)
+        preset = self._video_preset
+        if asset_path.endswith(".mp4") and preset.keeps_mp4():
+            return self._pass_through_asset(asset_path)
+
+        return self._convert_cached(asset_path, ".mp4", functools.partial(_encode_mp4, preset=preset), {'codec': 'libx264', **preset.to_json()})
+
+    def _convert_cached(self, asset_path, extension, encoder, settings, buffered=False) -> MediaItem:
+
+        # an asset used by several cards or fields is converted once per build
+        stat = os.stat(asset_path)
+        converted_key = (os.path.realpath(asset_path), stat.st_size, stat.st_mtime_ns, extension, json_digest(settings))
+
+        with self._path_lock(converted_key), self._profile.stage("convert_" + extension[1:]) as timer:
+            timer.bytes_in = stat.st_size
+            timer.hit = True
+
+            item = self._converted.get(converted_key)
+            if item is None or not item.exists():
+                item = self._convert(asset_path, extension, encoder, settings, buffered, timer)
+                # in-memory payloads aren't kept around, they'd pin every buffer for the whole build
+                if item.path is not None:
+                    self._converted[converted_key] = item
+
+            timer.bytes_out = len(item.data) if item.data is not None else os.path.getsize(item.path)
+            return item
+
+    def _convert(self, asset_path, extension, encoder, settings, buffered, timer) -> MediaItem:
 
-        temp_file_path = self._temp_asset_path(asset_path)
-        temp_file_path = os.path.splitext(temp_file_path)[0] + ".mp4"
+        name = os.path.splitext(os.path.basename(self._asset_final_name(asset_path)))[0] + extension
 
-        clip = VideoFileClip(asset_path)
-        clip.write_videofile(temp_file_path, codec='libx264')
+        # the cached payload is packaged in place, under the name the notes use
+        if self._cache is not None:
+            key = self._cache.key(asset_path, extension, settings)
+            payload_path = self._cache.get(key)
+            timer.hit = payload_path is not None
+            if payload_path is None:
+                payload_path = self._cache.put(key, extension, self._pooled(encoder), asset_path)
+            rebuild = functools.partial(self._convert_cached, asset_path, extension, encoder, settings, buffered)
+            return self._stage.reference(payload_path, name, rebuild)
 
-        return temp_file_path
+        timer.hit = False
+        if buffered:
+            if self._process_pool is not None:
+                data = self._process_pool.submit(_encode_to_bytes, encoder, asset_path).result()
+            else:
+                data = _encode_to_bytes(encoder, asset_path)
+            return self._stage.from_bytes(name, data)
 
+        temp_file_path = self._asset_temp_path(name, delete=False)
+        with self._path_lock(temp_file_path):
+            if os.path.isfile(temp_file_path):
+                os.remove(temp_file_path)
+            self._pooled(encoder)(asset_path, temp_file_path)
 
-    def _asset_temp_path(self, file_name):
+        return self._stage.reference(temp_file_path, name)
+
+    def _pooled(self, encoder):
+
+        if self._process_pool is None:
+            return encoder
+
+        process_pool = self._process_pool
+        return lambda source_path, destination_path: process_pool.submit(encoder, source_path, destination_path).result()
+
+    def _path_lock(self, path) -> threading.Lock:
+
+        with self._path_locks_lock:
+            return self._path_locks.setdefault(path, threading.Lock())
+
+
+    def _asset_temp_path(self, file_name, delete=True):
 
         # if self._temp_path is None or folder not exist
         if self._temp_path is None:
@@ -316,24 +781,49 @@ class FankiModelGeneric:
         if not os.path.isdir(self._temp_path):
             raise FileNotFoundError("{} is not a directory", self._temp_path)
 
-        temp_path = os.path.join(self._temp_path, self._deck_namespace + "." + self._deck_alias)
-        temp_path_full = os.path.join(temp_path, os.path.basename(file_name))
-        if not os.path.isdir(temp_path):
-            os.makedirs(temp_path)
-
+        temp_path_full = os.path.join(self._deck_temp_path(), os.path.basename(file_name))
 
         # if file exist, delete it
-        if os.path.isfile(temp_path_full):
+        if delete and os.path.isfile(temp_path_full):
             os.remove(temp_path_full)
 
         return temp_path_full
 
 
+    def _deck_temp_path(self):
+
+        temp_path = os.path.join(self._temp_path, self._deck_namespace + "." + self._deck_alias)
+        if not os.path.isdir(temp_path):
+            os.makedirs(temp_path, exist_ok=True)
+        return temp_path
+
+    def _package_path(self):
+        return os.path.join(self._packages_path, f"{self._deck_namespace}_{self._deck_alias}.apkg")
+
+    def _shards_index_path(self):
+        return os.path.join(self._packages_path, f"{self._deck_namespace}_{self._deck_alias}.shards.json")
+
+    def _delta_package_path(self):
+        return os.path.join(self._packages_path, f"{self._deck_namespace}_{self._deck_alias}.delta.apkg")
+
+    def check_assets(self) -> AssetReport:
+        """
+        Lists assets/ once and reports the references to missing files or to
+        types their field can't hold, and the asset files no card uses.
+        """
+        return self._check_assets(AssetIndex(self._path_assets))
+
+    def _check_assets(self, index) -> AssetReport:
+        return check_assets(self._deck_cards, index, self._field_plan, self._valid_any_files)
+
     def _asset_exists(self, file_name):
 
         if not file_name.startswith("assets/"):
             return None
 
+        if self._asset_index is not None:
+            return self._asset_index.resolve(file_name)
+
         if self._root_path is None:
             return None
         file_path = os.path.join(self._root_path, file_name)
@@ -348,7 +838,7 @@ class FankiModelGeneric:
         return file_name
 
     @classmethod
-    def import_deck(cls, data_file_path=None):
+    def import_deck(cls, data_file_path=None, stream=None):
 
 
         if data_file_path is None or not os.path.isdir(data_file_path):
@@ -362,14 +852,23 @@ class FankiModelGeneric:
         alias = os.path.basename(data_file_path)
         namespace = os.path.basename(os.path.dirname(data_file_path))
         json_file_path = os.path.join(data_file_path,  "data.json")
+        jsonl_file_path = os.path.join(data_file_path, "cards.jsonl")
 
         if not os.path.isfile(json_file_path):
             raise FileNotFoundError("File {} not found".format(json_file_path))
 
+        if stream is None:
+            stream = os.path.isfile(jsonl_file_path) or os.path.getsize(json_file_path) > int(os.environ.get("FANKI_STREAM_THRESHOLD", STREAM_THRESHOLD))
+
+        if stream:
+            return cls._import_deck_stream(data_file_path, namespace, alias, json_file_path, jsonl_file_path)
+
+        wall, cpu = time.perf_counter(), time.process_time()
         with open(json_file_path, 'r') as file:
             json_content = file.read()
             # import json content
             data = json.loads(json_content)
+            import_stats = {'wall': time.perf_counter() - wall, 'cpu': time.process_time() - cpu, 'bytes_in': len(json_content)}
 
             deck_id = data.get('id')
             deck_name = data.get('name')
@@ -393,23 +892,159 @@ class FankiModelGeneric:
                 deck_name=deck_name,
                 deck_namespace=deck_namespace,
                 deck_alias=deck_alias,
-                root_path=data_file_path
+                root_path=data_file_path,
+                image_preset=data.get('image_preset'),
+                audio_preset=data.get('audio_preset'),
+                video_preset=data.get('video_preset'),
+                shards=data.get('shards')
             )
             deck.import_cards(deck_cards)
+            deck._import_stats = import_stats
 
             return deck
 
         pass
 
-    def generate(self):
+    @classmethod
+    def _import_deck_stream(cls, data_file_path, namespace, alias, json_file_path, jsonl_file_path):
+
+        # cards.jsonl (one card per line) takes precedence over the cards array in data.json
+        # only the header is read here, the cards are parsed as the build pulls them
+        wall, cpu = time.perf_counter(), time.process_time()
+        header = read_deck_header(json_file_path)
+        import_stats = {'wall': time.perf_counter() - wall, 'cpu': time.process_time() - cpu, 'bytes_in': os.path.getsize(json_file_path)}
+
+        if os.path.isfile(jsonl_file_path):
+            cards_factory = lambda: iter_jsonl_cards(jsonl_file_path)
+            has_cards = os.path.getsize(jsonl_file_path) > 0
+        else:
+            cards_factory = lambda: iter_deck_cards(json_file_path)
+            has_cards = bool(header.get('cards'))
+
+        if header.get('id') is None:
+            raise ValueError("deck_id is required")
+        if header.get('name') is None:
+            raise ValueError("deck_name is required")
+        if not has_cards:
+            raise ValueError("cards is required")
+
+        deck = cls(
+            deck_id=int(header.get('id')),
+            deck_name=header.get('name'),
+            deck_namespace=namespace,
+            deck_alias=alias,
+            root_path=data_file_path,
+            image_preset=header.get('image_preset'),
+            audio_preset=header.get('audio_preset'),
+            video_preset=header.get('video_preset'),
+            shards=header.get('shards')
+        )
+        deck.import_card_stream(cards_factory)
+        deck._import_stats = import_stats
+
+        return deck
+
+    def generate(self, jobs=None, force=False, process_pool=None, shared_media=None, profile=None, delta=None, thread_pool=None):
+        """
+        Builds the deck's package and returns its path. Sharded decks (see
+        ``ShardPolicy``) are written as several packages side by side, and the
+        path returned is then the one of their ``.shards.json`` index.
+
+        ``delta`` also writes ``<package>.delta.apkg`` with only the notes and
+        media that changed since the previous build, for an import that
+        doesn't go through the whole deck. It defaults to FANKI_DELTA=1.
+
+        Notes are identified by their key (see ``_note_key``). Packages
+        built before that gave notes a GUID derived from their fields; the
+        notes still found in the deck's previous package keep it, so keep
+        that package in place for the first build after upgrading, or the
+        import duplicates every note.
+
+        Before anything is converted the assets are checked (see
+        ``check_assets``) and the build fails if a card references a missing
+        file; FANKI_PREFLIGHT=warn only reports it, FANKI_PREFLIGHT=0 skips
+        the check.
+
+        ``profile`` turns on per-stage instrumentation: True prints a report
+        once the deck is built, a directory path writes it there as JSON, and
+        a ``BuildProfile`` is filled in and left to the caller. It defaults to
+        FANKI_PROFILE; FANKI_PROFILE_MEMORY=1 also tracks the tracemalloc peak.
+
+        ``process_pool`` and ``thread_pool`` let decks built at the same time
+        share their workers; without them the build opens ``jobs`` processes
+        and ``jobs * 4`` threads of its own.
+        """
+
+        if profile is None:
+            profile = os.environ.get("FANKI_PROFILE", "0")
+            profile = None if profile == "0" else True if profile == "1" else profile
+
+        if not profile or isinstance(profile, BuildProfile):
+            return self._generate(jobs, force, process_pool, shared_media, profile or None, delta, thread_pool)
+
+        build_profile = BuildProfile(f"{self._deck_namespace}/{self._deck_alias}", track_memory=os.environ.get("FANKI_PROFILE_MEMORY", "0") == "1")
+        with build_profile:
+            dest_file = self._generate(jobs, force, process_pool, shared_media, build_profile, delta, thread_pool)
+
+        if profile is True:
+            print(build_profile.report())
+        else:
+            os.makedirs(profile, exist_ok=True)
+            build_profile.write(os.path.join(profile, f"{self._deck_namespace}_{self._deck_alias}.json"))
+
+        return dest_file
+
+    def _generate(self, jobs, force, process_pool, shared_media, profile, delta, thread_pool):
 
         if self._root_path is None:
             raise ValueError("root_path is required")
 
-        anki_package = genanki.Package(self._get_deck_instance())
-
-        if len(self._deck_media) > 0:
-            anki_package.media_files = self._deck_media
+        self._profile = profile if profile is not None else NullProfile()
+        try:
+            return self._write_package(jobs, force, process_pool, shared_media, delta, thread_pool)
+        finally:
+            self._profile = NullProfile()
+            self._asset_index = None
+
+    def _write_package(self, jobs, force, process_pool, shared_media, delta, thread_pool):
+
+        if self._import_stats is not None:
+            self._profile.add("json_load", **self._import_stats)
+
+        if jobs is None:
+            jobs = int(os.environ.get("FANKI_JOBS", 1))
+
+        if shared_media is None:
+            shared_media = os.environ.get("FANKI_SHARED_MEDIA", "0") == "1"
+
+        if delta is None:
+            delta = os.environ.get("FANKI_DELTA", "0") == "1"
+
+        # one listing of assets/ that every reference of this build resolves against
+        self._asset_index = AssetIndex(self._path_assets)
+
+        dest_file = self._shards_index_path() if self._shards is not None else self._package_path()
+        manifest_path = os.path.join(self._deck_temp_path(), "manifest.sqlite")
+        with self._profile.stage("build_inputs"):
+            manifest = BuildManifest.load(manifest_path)
+            inputs = self._build_inputs()
+            inputs['shared_media'] = shared_media
+            inputs['shards'] = self._shards.to_json() if self._shards is not None else None
+
+        if not force and manifest.is_up_to_date(inputs, dest_file):
+            print(f"{self._deck_namespace}/{self._deck_alias} is up to date")
+            return dest_file
+
+        # checked before anything is converted or synthesised, so a broken
+        # deck fails in seconds rather than at the end of the build
+        preflight = os.environ.get("FANKI_PREFLIGHT", "strict")
+        if preflight != "0":
+            with self._profile.stage("preflight"):
+                report = self._check_assets(self._asset_index)
+            if not report.clean:
+                print(report.summary(f"{self._deck_namespace}/{self._deck_alias}"))
+            if preflight == "strict" and not report.ok:
+                raise FileNotFoundError(f"{len(report.missing)} assets of {self._deck_namespace}/{self._deck_alias} not found")
 
         # remove all .apkg files in self._root_path directory
         for file in os.listdir(self._root_path):
@@ -419,8 +1054,75 @@ class FankiModelGeneric:
         #dest_file = os.path.join(self._root_path, "package.apkg")
         #anki_package.write_to_file(dest_file)
 
-        dest_file = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "packages", f"{self._deck_namespace}_{self._deck_alias}.apkg")
-        anki_package.write_to_file(dest_file)
+        # without a manifest of its own the previous package may come from
+        # before GUIDs were keyed, its notes are looked up in a copy
+        legacy = not manifest.has_previous and os.path.isfile(self._package_path())
+
+        # a forced build doesn't reuse the cards of the previous build, the
+        # delta is still taken against its notes
+        manifest.begin(reuse_cards=not force, legacy_package=self._package_path() if legacy else None)
+
+        # outputs of the previous build, sharded or not
+        for file_path in (self._package_path(), self._delta_package_path()):
+            if os.path.isfile(file_path):
+                os.remove(file_path)
+        ShardedPackageWriter.remove(self._shards_index_path())
+        delta_file = self._delta_package_path()
+
+        if delta and not manifest.has_previous_notes:
+            print(f"{self._deck_namespace}/{self._deck_alias} has no previous build, skipping the delta package")
+            delta = False
+
+        # notes and media are written as each card comes out of the pipeline,
+        # so packaging overlaps with the conversions still running
+        model = self._get_model_instance()
+        timestamp = self._source_date()
+        self._manifest = manifest
+        try:
+            if self._shards is not None:
+                packages = [ShardedPackageWriter(dest_file, self._deck_id, self._deck_name, model, self._shards, timestamp)]
+            else:
+                packages = [PackageWriter(dest_file, self._deck_id, self._deck_name, model, timestamp)]
+            if delta:
+                packages.append(PackageWriter(delta_file, self._deck_id, self._deck_name, model, timestamp))
+            try:
+                for note, media in self._iter_notes(model, jobs, process_pool, shared_media, thread_pool):
+                    with self._profile.stage("package_write"):
+                        media = [item.restored() for item in media]
+                        digest = json_digest([note.fields, [item.fingerprint() for item in media]])
+                        manifest.put_note(note.guid, digest)
+                        changed = delta and manifest.previous_note(note.guid) != digest
+                        for package in packages if changed else packages[:1]:
+                            package.add_note(note)
+                            for media_path in media:
+                                package.add_media(media_path)
+            except BaseException:
+                for package in packages:
+                    package.abort()
+                raise
+
+            with self._profile.stage("package_close") as timer:
+                for package in packages:
+                    package.close()
+                package_files = packages[0].file_paths if self._shards is not None else [dest_file]
+                timer.bytes_out = sum(os.path.getsize(file_path) for file_path in package_files)
+
+            if legacy and manifest.kept_guids():
+                print(f"{self._deck_namespace}/{self._deck_alias}: {manifest.kept_guids()} notes keep the GUID of the previous package")
+
+            if delta:
+                removed = manifest.removed_notes()
+                print(f"{self._deck_namespace}/{self._deck_alias}: {packages[1].note_count} changed notes in {os.path.basename(delta_file)}"
+                      + (f", {removed} removed notes have to be deleted in Anki" if removed else ""))
+        except BaseException:
+            manifest.discard()
+            raise
+        finally:
+            self._manifest = None
+
+        manifest.save(inputs)
+
+        return dest_file
 
 
     def set_root_paht(self, caller_dir_path):
@@ -449,9 +1151,13 @@ class FankiModelDefault(FankiModelGeneric):
         self._f_model.add_field('back_sentence_audio')
         self._f_model.add_field('back_ipa')
 
-    def add_card(self, front=None, front_image=None, front_audio=None, back=None, back_tts=None, back_image=None, back_audio=None, back_sentence=None, back_sentence_tts=None, back_sentence_audio=None, ipa=None):
+    def add_card(self, front=None, front_image=None, front_audio=None, back=None, back_tts=None, back_image=None, back_audio=None, back_sentence=None, back_sentence_tts=None, back_sentence_audio=None, ipa=None, key=None):
 
-        self._deck_cards.append({
+        self._deck_cards.append(self._new_card(front, front_image, front_audio, back, back_tts, back_image, back_audio, back_sentence, back_sentence_tts, back_sentence_audio, ipa, key))
+
+    def _new_card(self, front=None, front_image=None, front_audio=None, back=None, back_tts=None, back_image=None, back_audio=None, back_sentence=None, back_sentence_tts=None, back_sentence_audio=None, ipa=None, key=None):
+
+        return {
             'front': front,
             'front_image': front_image,
             'front_audio': front_audio,
@@ -462,24 +1168,30 @@ class FankiModelDefault(FankiModelGeneric):
             'back_sentence': back_sentence,
             'back_sentence_tts': back_sentence_tts,
             'back_sentence_audio': back_sentence_audio,
-            'back_ipa': ipa
-        })
+            'back_ipa': ipa,
+            NOTE_KEY_FIELD: key
+        }
 
     def import_cards(self, data):
 
         for card in data:
 
-            self.add_card(
-                front=card.get('front'),
-                front_image=card.get('front_image'),
-                front_audio=card.get('front_audio'),
-                back=card.get('back'),
-                back_tts=card.get('back_tts'),
-                back_image=card.get('back_image'),
-                back_audio=card.get('back_audio'),
-                back_sentence=card.get('back_sentence'),
-                back_sentence_tts=card.get('back_sentence_tts'),
-                back_sentence_audio=card.get('back_sentence_audio'),
-                ipa=card.get('back_ipa')
-            )
+            self._deck_cards.append(self._card_from_data(card))
+
+    def _card_from_data(self, card) -> dict:
+
+        return self._new_card(
+            front=card.get('front'),
+            front_image=card.get('front_image'),
+            front_audio=card.get('front_audio'),
+            back=card.get('back'),
+            back_tts=card.get('back_tts'),
+            back_image=card.get('back_image'),
+            back_audio=card.get('back_audio'),
+            back_sentence=card.get('back_sentence'),
+            back_sentence_tts=card.get('back_sentence_tts'),
+            back_sentence_audio=card.get('back_sentence_audio'),
+            ipa=card.get('back_ipa'),
+            key=card.get(NOTE_KEY_FIELD)
+        )
 
@@ -0,0 +1,166 @@
+import functools
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+
+
+@functools.lru_cache(maxsize=None)
+def ffmpeg_executable() -> str:
+    """
+    Returns the ffmpeg to run: FANKI_FFMPEG, the one on PATH, or the binary
+    bundled with imageio-ffmpeg.
+    """
+
+    executable = os.environ.get("FANKI_FFMPEG") or shutil.which("ffmpeg")
+    if executable is not None:
+        return executable
+
+    try:
+        import imageio_ffmpeg
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except (ImportError, RuntimeError):
+        raise FileNotFoundError("ffmpeg not found, install it or set FANKI_FFMPEG")
+
+
+def run_ffmpeg(arguments, destination=None, input=None):
+    """
+    Runs ffmpeg with ``arguments``. When ``destination`` is a file object the
+    output is read from ffmpeg's stdout and copied into it in chunks, so
+    nothing but the encoded bytes passes through this process. ``input`` is
+    written to ffmpeg's stdin, for ``pipe:0`` inputs small enough to hold in
+    memory.
+    """
+
+    # stdin stays closed to ffmpeg unless it is the input
+    stdin = ["-nostdin"] if input is None else []
+    command = [ffmpeg_executable(), *stdin, "-hide_banner", "-loglevel", "error", "-y", *arguments]
+
+    if input is not None:
+        result = subprocess.run(command, input=input, stdout=subprocess.PIPE if destination is not None else subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if result.returncode == 0 and destination is not None:
+            destination.write(result.stdout)
+        stderr = result.stderr
+        returncode = result.returncode
+    elif destination is None:
+        result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        stderr = result.stderr
+        returncode = result.returncode
+    else:
+        # stderr goes to a file, a full stderr pipe would stall ffmpeg while stdout is drained
+        with tempfile.TemporaryFile() as errors, subprocess.Popen(command, stdout=subprocess.PIPE, stderr=errors) as process:
+            shutil.copyfileobj(process.stdout, destination)
+            returncode = process.wait()
+            errors.seek(0)
+            stderr = errors.read()
+
+    if returncode != 0:
+        message = stderr.decode(errors="replace").strip().splitlines()
+        raise RuntimeError(f"ffmpeg failed: {message[-1] if message else returncode}")
+
+
+class MediaInfo:
+    """
+    The streams of a media file as ffmpeg describes them: ``duration`` in
+    seconds (None when unknown), ``video`` and ``audio`` lists of dicts with
+    the ``codec`` and, for video, ``pixel_format``, ``width`` and ``height``.
+    """
+
+    __slots__ = ('duration', 'video', 'audio')
+
+    def __init__(self, duration=None, video=None, audio=None):
+        self.duration = duration
+        self.video = video if video is not None else []
+        self.audio = audio if audio is not None else []
+
+
+_DURATION_PATTERN = re.compile(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)")
+_SILENCE_PATTERN = re.compile(r"silence_(start|end): (-?\d+(?:\.\d+)?)")
+_TIME_PATTERN = re.compile(r"time=(\d+):(\d+):(\d+(?:\.\d+)?)")
+_STREAM_PATTERN = re.compile(r"Stream #\d+:\d+.*?: (Video|Audio): (\w+)(.*)")
+_SIZE_PATTERN = re.compile(r"\b(\d{2,5})x(\d{2,5})\b")
+
+
+def probe(source_path) -> MediaInfo:
+    """
+    Reads the stream layout of ``source_path`` from ``ffmpeg -i``, which only
+    parses the headers. ffprobe isn't needed, imageio-ffmpeg doesn't ship it.
+    """
+
+    if not os.path.isfile(source_path):
+        raise FileNotFoundError(f"{source_path} is not a file")
+
+    # without an output ffmpeg prints the input description and exits with an error
+    result = subprocess.run([ffmpeg_executable(), "-nostdin", "-hide_banner", "-i", source_path], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    description = result.stderr.decode(errors="replace")
+
+    info = MediaInfo()
+
+    match = _DURATION_PATTERN.search(description)
+    if match is not None:
+        hours, minutes, seconds = match.groups()
+        info.duration = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+    for line in description.splitlines():
+        match = _STREAM_PATTERN.search(line)
+        if match is None or "(attached pic)" in line:
+            continue
+
+        kind, codec, details = match.groups()
+        if kind == "Audio":
+            info.audio.append({'codec': codec})
+            continue
+
+        size = _SIZE_PATTERN.search(details)
+        info.video.append({
+            'codec': codec,
+            'pixel_format': details.split(",")[1].strip().split("(")[0] if "," in details else None,
+            'width': int(size.group(1)) if size else None,
+            'height': int(size.group(2)) if size else None,
+        })
+
+    return info
+
+
+def trailing_silence(source_path, threshold, duration=0.1):
+    """
+    Returns the second at which the silence that ends ``source_path`` starts,
+    or None if it doesn't end in at least ``duration`` seconds below
+    ``threshold``. The clip is decoded once by silencedetect, which only
+    keeps its current window in memory.
+    """
+
+    if not os.path.isfile(source_path):
+        raise FileNotFoundError(f"{source_path} is not a file")
+
+    command = [ffmpeg_executable(), "-nostdin", "-hide_banner", "-i", source_path, "-map", "0:a:0",
+               "-af", f"silencedetect=n={threshold}:d={duration}", "-f", "null", "-"]
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    output = result.stderr.decode(errors="replace")
+
+    if result.returncode != 0:
+        message = output.strip().splitlines()
+        raise RuntimeError(f"ffmpeg failed: {message[-1] if message else result.returncode}")
+
+    start = end = None
+    for kind, seconds in _SILENCE_PATTERN.findall(output):
+        if kind == "start":
+            start, end = float(seconds), None
+        else:
+            end = float(seconds)
+
+    if start is None:
+        return None
+
+    # silencedetect also closes a silence at the end of the stream, so the
+    # last one only ends the clip if it lasts until the last progress time
+    if end is not None:
+        times = _TIME_PATTERN.findall(output)
+        if not times:
+            return None
+        hours, minutes, seconds = times[-1]
+        if end < int(hours) * 3600 + int(minutes) * 60 + float(seconds) - 0.01:
+            return None
+
+    return start
@@ -0,0 +1,250 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+from anki.package import extract_collection
+
+MANIFEST_VERSION = 5
+
+
+def json_digest(value) -> str:
+    return hashlib.sha256(json.dumps(value, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+
+def _read_only_uri(path) -> str:
+    return "file:" + os.path.abspath(path).replace("?", "%3f").replace("#", "%23") + "?mode=ro"
+
+
+def _read_inputs(manifest_path):
+    """
+    The inputs recorded by a previous build, or None if there is no usable
+    manifest at ``manifest_path``.
+    """
+
+    if not os.path.isfile(manifest_path):
+        return None
+
+    try:
+        conn = sqlite3.connect(_read_only_uri(manifest_path), uri=True)
+        try:
+            meta = dict(conn.execute("SELECT name, value FROM meta").fetchall())
+        finally:
+            conn.close()
+    except sqlite3.DatabaseError:
+        return None
+
+    if meta.get('version') != str(MANIFEST_VERSION):
+        return None
+    return json.loads(meta.get('inputs', "{}"))
+
+
+class _Occurrences:
+    """
+    Per-key counters kept in the build's database, with the ``get`` and item
+    assignment of the dict they stand in for.
+    """
+
+    __slots__ = ('_manifest',)
+
+    def __init__(self, manifest):
+        self._manifest = manifest
+
+    def get(self, key, default=None):
+        row = self._manifest._query("SELECT count FROM temp.occurrences WHERE key = ?", (key,))
+        return default if row is None else row[0]
+
+    def __setitem__(self, key, count):
+        self._manifest._execute("INSERT OR REPLACE INTO temp.occurrences (key, count) VALUES (?, ?)", (key, count))
+
+
+class BuildManifest:
+    """
+    Record of a deck build, stored as ``manifest.sqlite`` in the deck temp
+    folder: the hashes of every build input plus the parsed fields and media
+    of each card, keyed by a hash of the raw card and the assets it uses,
+    a digest of each note keyed by its GUID, and the notes that kept a GUID
+    from before GUIDs were derived from note keys.
+
+    A build writes its entries to a new database as the cards come out of
+    the pipeline and only looks the previous build up by key, so neither is
+    held in memory. ``save`` replaces the previous database with the new one.
+    """
+
+    def __init__(self, manifest_path, inputs=None):
+
+        if manifest_path is None:
+            raise ValueError("manifest_path is required")
+
+        self._manifest_path = manifest_path
+        self._tmp_path = manifest_path + ".tmp"
+        self._legacy_path = manifest_path + ".legacy"
+        self._has_previous = False
+        self._has_legacy = False
+        self._reuse_cards = False
+        self._conn = None
+        self._lock = threading.Lock()
+        self.inputs = inputs or {}
+
+    @classmethod
+    def load(cls, manifest_path):
+
+        inputs = _read_inputs(manifest_path)
+        manifest = cls(manifest_path, inputs=inputs)
+        manifest._has_previous = inputs is not None
+        return manifest
+
+    def is_up_to_date(self, inputs, package_path) -> bool:
+        return self._has_previous and self.inputs == inputs and os.path.isfile(package_path)
+
+    @property
+    def has_previous(self) -> bool:
+        return self._has_previous
+
+    def begin(self, reuse_cards=True, legacy_package=None):
+        """
+        Starts recording a build. Cards of the previous build are only
+        handed out with ``reuse_cards``, its notes are looked up either way.
+        ``legacy_package`` is the .apkg of a build without a usable manifest,
+        whose notes ``kept_guid`` looks up.
+        """
+
+        for path in (self._tmp_path, self._legacy_path):
+            if os.path.isfile(path):
+                os.remove(path)
+
+        # shared by the threads parsing cards, every use holds self._lock
+        conn = sqlite3.connect(self._tmp_path, uri=True, check_same_thread=False)
+        conn.executescript(
+            "CREATE TABLE meta (name TEXT PRIMARY KEY, value TEXT NOT NULL);"
+            "CREATE TABLE cards (key TEXT PRIMARY KEY, card TEXT NOT NULL, media TEXT NOT NULL);"
+            "CREATE TABLE notes (guid TEXT PRIMARY KEY, digest TEXT NOT NULL);"
+            "CREATE TABLE guids (guid TEXT PRIMARY KEY, kept TEXT NOT NULL);"
+            "CREATE TEMP TABLE occurrences (key TEXT PRIMARY KEY, count INTEGER NOT NULL);"
+        )
+        if self._has_previous:
+            conn.execute("ATTACH DATABASE ? AS previous", (_read_only_uri(self._manifest_path),))
+
+        # a copy, sqlite can't read the collection inside the zip
+        self._has_legacy = legacy_package is not None and extract_collection(legacy_package, self._legacy_path)
+        if self._has_legacy:
+            conn.execute("ATTACH DATABASE ? AS legacy", (_read_only_uri(self._legacy_path),))
+
+        self._conn = conn
+        self._reuse_cards = reuse_cards and self._has_previous
+
+    def _query(self, sql, parameters=()):
+        with self._lock:
+            return self._conn.execute(sql, parameters).fetchone()
+
+    def _execute(self, sql, parameters=()):
+        with self._lock:
+            self._conn.execute(sql, parameters)
+
+    def get_card(self, card_key):
+
+        if not self._reuse_cards:
+            return None
+
+        row = self._query("SELECT card, media FROM previous.cards WHERE key = ?", (card_key,))
+        if row is None:
+            return None
+
+        entry = {'card': json.loads(row[0]), 'media': json.loads(row[1])}
+
+        # the outputs must still be on disk to be reused; media that was only
+        # held in memory is recorded as None
+        if not all(media is not None and os.path.isfile(media[1]) for media in entry['media']):
+            return None
+
+        return entry
+
+    def put_card(self, card_key, card, media):
+        self._execute("INSERT OR REPLACE INTO cards (key, card, media) VALUES (?, ?, ?)",
+                      (card_key, json.dumps(card, ensure_ascii=False), json.dumps(media, ensure_ascii=False)))
+
+    @property
+    def has_previous_notes(self) -> bool:
+        return self._has_previous and self._query("SELECT 1 FROM previous.notes LIMIT 1") is not None
+
+    def previous_note(self, guid):
+
+        if not self._has_previous:
+            return None
+
+        row = self._query("SELECT digest FROM previous.notes WHERE guid = ?", (guid,))
+        return row[0] if row is not None else None
+
+    def put_note(self, guid, digest):
+        self._execute("INSERT OR REPLACE INTO notes (guid, digest) VALUES (?, ?)", (guid, digest))
+
+    def kept_guid(self, guid, legacy_guid):
+        """
+        The GUID of the note that ``guid`` identifies: the one it kept in
+        the previous build, else ``legacy_guid()`` if the legacy package
+        holds a note with it, else ``guid`` itself.
+        """
+
+        row = self._query("SELECT kept FROM previous.guids WHERE guid = ?", (guid,)) if self._has_previous else None
+        kept = row[0] if row is not None else None
+
+        if kept is None and self._has_legacy:
+            candidate = legacy_guid()
+            if self._query("SELECT 1 FROM legacy.notes WHERE guid = ?", (candidate,)) is not None:
+                kept = candidate
+
+        if kept is None:
+            return guid
+
+        self._execute("INSERT OR REPLACE INTO guids (guid, kept) VALUES (?, ?)", (guid, kept))
+        return kept
+
+    def kept_guids(self) -> int:
+        return self._query("SELECT COUNT(*) FROM guids")[0]
+
+    def removed_notes(self) -> int:
+        """
+        Number of notes of the previous build that this one didn't write.
+        """
+
+        if not self._has_previous:
+            return 0
+        return self._query("SELECT COUNT(*) FROM previous.notes WHERE guid NOT IN (SELECT guid FROM main.notes)")[0]
+
+    def occurrences(self):
+        return _Occurrences(self)
+
+    def save(self, inputs):
+
+        with self._lock:
+            self._conn.executemany("INSERT INTO meta (name, value) VALUES (?, ?)",
+                                   [('version', str(MANIFEST_VERSION)), ('inputs', json.dumps(inputs, ensure_ascii=False))])
+            self._conn.commit()
+            self._conn.close()
+            self._conn = None
+
+        os.replace(self._tmp_path, self._manifest_path)
+        self._remove_legacy()
+        self.inputs = inputs
+        self._has_previous = True
+
+    def discard(self):
+        """
+        Drops the entries of a build that didn't finish.
+        """
+
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+        if os.path.isfile(self._tmp_path):
+            os.remove(self._tmp_path)
+        self._remove_legacy()
+
+    def _remove_legacy(self):
+
+        self._has_legacy = False
+        if os.path.isfile(self._legacy_path):
+            os.remove(self._legacy_path)
@@ -0,0 +1,154 @@
+import itertools
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import zipfile
+
+ZIP_EPOCH = 315532800
+
+
+def extract_collection(package_path, destination_path) -> bool:
+    """
+    Copies the collection database out of the .apkg at ``package_path``.
+    Returns False when it isn't a readable package.
+    """
+
+    try:
+        with zipfile.ZipFile(package_path) as package, package.open('collection.anki2') as source, open(destination_path, 'wb') as destination:
+            shutil.copyfileobj(source, destination, 1024 * 1024)
+    except (OSError, KeyError, zipfile.BadZipFile):
+        return False
+    return True
+
+
+class PackageWriter:
+    """
+    Writes an .apkg incrementally: notes go into the collection sqlite in
+    batched transactions and media files are streamed into the zip as soon
+    as they are added, so neither the notes nor the media list of a deck
+    have to be held in memory. The output has the same layout as
+    ``genanki.Package.write_to_file``.
+
+    Note ids, modification times and the dates of the zip entries all come
+    from ``timestamp``, so writing the same notes and media with the same
+    timestamp gives the same bytes.
+    """
+
+    def __init__(self, file_path, deck_id, deck_name, model, timestamp=None, batch_size=1000):
+        import genanki
+        from genanki.apkg_col import APKG_COL
+        from genanki.apkg_schema import APKG_SCHEMA
+
+        if file_path is None:
+            raise ValueError("file_path is required")
+
+        self._file_path = file_path
+        self._deck_id = deck_id
+        self._timestamp = timestamp if timestamp is not None else time.time()
+        self._id_gen = itertools.count(int(self._timestamp * 1000))
+        # zip can't store dates before 1980
+        self._date_time = time.gmtime(max(self._timestamp, ZIP_EPOCH))[:6]
+        self._batch_size = batch_size
+        self._pending_notes = 0
+        self._media_names = {}
+        self._media_seen = set()
+        self.note_count = 0
+
+        db_file, self._db_path = tempfile.mkstemp(suffix=".anki2")
+        os.close(db_file)
+
+        self._conn = sqlite3.connect(self._db_path)
+        self._cursor = self._conn.cursor()
+        self._cursor.executescript(APKG_SCHEMA)
+        self._cursor.executescript(APKG_COL)
+
+        deck = genanki.Deck(deck_id, deck_name)
+        decks_json_str, = self._cursor.execute('SELECT decks FROM col').fetchone()
+        decks = json.loads(decks_json_str)
+        decks.update({str(deck_id): deck.to_json()})
+        self._cursor.execute('UPDATE col SET decks = ?', (json.dumps(decks),))
+
+        models_json_str, = self._cursor.execute('SELECT models FROM col').fetchone()
+        models = json.loads(models_json_str)
+        models.update({model.model_id: model.to_json(self._timestamp, deck_id)})
+        self._cursor.execute('UPDATE col SET models = ?', (json.dumps(models),))
+        self._conn.commit()
+
+        self._zip_path = file_path + ".tmp"
+        self._zip = zipfile.ZipFile(self._zip_path, 'w')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def add_note(self, note):
+
+        note.write_to_db(self._cursor, self._timestamp, self._deck_id, self._id_gen)
+        self.note_count += 1
+        self._pending_notes += 1
+
+        if self._pending_notes >= self._batch_size:
+            self._conn.commit()
+            self._pending_notes = 0
+
+    def add_media(self, item):
+        """
+        Adds an ``anki.staging.MediaItem``, read from its path or written
+        straight from its in-memory buffer.
+        """
+
+        # the same file referenced by several notes is stored once
+        if item.name in self._media_seen:
+            return
+
+        item = item.restored()
+
+        index = str(len(self._media_names))
+        if item.data is not None:
+            self._zip.writestr(self._zip_info(index), item.data)
+        else:
+            self._write_file(item.path, index)
+
+        self._media_names[index] = item.name
+        self._media_seen.add(item.name)
+
+    def _zip_info(self, name, file_size=0) -> zipfile.ZipInfo:
+
+        info = zipfile.ZipInfo(name, self._date_time)
+        info.external_attr = 0o600 << 16
+        info.file_size = file_size
+        return info
+
+    def _write_file(self, path, name):
+
+        with open(path, 'rb') as source, self._zip.open(self._zip_info(name, os.path.getsize(path)), 'w') as destination:
+            shutil.copyfileobj(source, destination, 1024 * 1024)
+
+    def close(self):
+
+        self._conn.commit()
+        self._conn.close()
+
+        self._write_file(self._db_path, 'collection.anki2')
+        self._zip.writestr(self._zip_info('media'), json.dumps(self._media_names))
+        self._zip.close()
+        os.remove(self._db_path)
+
+        os.replace(self._zip_path, self._file_path)
+
+    def abort(self):
+
+        self._conn.close()
+        self._zip.close()
+        for path in (self._db_path, self._zip_path):
+            if os.path.isfile(path):
+                os.remove(path)
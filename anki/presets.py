@@ -0,0 +1,273 @@
+class ImagePreset:
+    """
+    How images are encoded to WebP: ``max_size`` is the (width, height) box
+    images are scaled down to fit, ``quality`` and ``method`` are passed to
+    the WebP encoder, ``lossless`` suits flat graphics such as the colour
+    swatches, and ``exif_transpose`` applies the EXIF orientation first.
+    """
+
+    __slots__ = ('max_size', 'quality', 'method', 'lossless', 'exif_transpose')
+
+    def __init__(self, max_size=None, quality=80, method=4, lossless=False, exif_transpose=True):
+
+        if max_size is not None:
+            max_size = tuple(int(size) for size in max_size)
+            if len(max_size) != 2 or min(max_size) <= 0:
+                raise ValueError("max_size must be a (width, height) pair")
+
+        if not 0 <= quality <= 100:
+            raise ValueError("quality must be between 0 and 100")
+
+        if not 0 <= method <= 6:
+            raise ValueError("method must be between 0 and 6")
+
+        self.max_size = max_size
+        self.quality = quality
+        self.method = method
+        self.lossless = lossless
+        self.exif_transpose = exif_transpose
+
+    def to_json(self):
+        return {
+            'max_size': list(self.max_size) if self.max_size is not None else None,
+            'quality': self.quality,
+            'method': self.method,
+            'lossless': self.lossless,
+            'exif_transpose': self.exif_transpose,
+        }
+
+    def fits(self, size) -> bool:
+        return self.max_size is None or (size[0] <= self.max_size[0] and size[1] <= self.max_size[1])
+
+
+class AudioPreset:
+    """
+    How audio is transcoded to Ogg: ``codec`` is opus or vorbis, ``bitrate``
+    (e.g. "32k"), ``sample_rate`` and ``channels`` are left to ffmpeg when
+    None, and ``trim_silence`` drops the silence below ``silence_threshold``
+    at the start and the end of the clip, keeping ``silence_padding``
+    seconds of it. Pauses inside the clip are left alone.
+
+    The end of the clip is found by a silencedetect pass before the encode,
+    so trimmed files are decoded twice; neither pass holds more than a few
+    frames of audio in memory.
+    """
+
+    __slots__ = ('codec', 'bitrate', 'sample_rate', 'channels', 'trim_silence', 'silence_threshold', 'silence_padding')
+
+    def __init__(self, codec='vorbis', bitrate=None, sample_rate=None, channels=None, trim_silence=False, silence_threshold='-50dB', silence_padding=0.1):
+
+        if codec not in ('opus', 'vorbis'):
+            raise ValueError("codec must be opus or vorbis")
+
+        if channels is not None and channels not in (1, 2):
+            raise ValueError("channels must be 1 or 2")
+
+        self.codec = codec
+        self.bitrate = bitrate
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.trim_silence = trim_silence
+        self.silence_threshold = silence_threshold
+        self.silence_padding = silence_padding
+
+    def to_json(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def keeps_ogg(self) -> bool:
+        """
+        True when .ogg assets can be packaged as they are.
+        """
+        return self.to_json() == AudioPreset().to_json()
+
+    def ffmpeg_arguments(self, end=None):
+        """
+        The output arguments of the encode. ``end`` is the second at which
+        the trailing silence of the source starts, from ``trailing_silence``.
+        """
+
+        arguments = ["-vn", "-map_metadata", "-1"]
+
+        if self.channels is not None:
+            arguments += ["-ac", str(self.channels)]
+
+        if self.sample_rate is not None:
+            arguments += ["-ar", str(self.sample_rate)]
+
+        if self.trim_silence:
+            # the trailing silence is cut at a known time instead of trimmed as
+            # the leading silence of the reversed clip, areverse buffers the
+            # whole decoded clip
+            filters = [f"atrim=end={end + self.silence_padding}"] if end is not None else []
+            filters.append(f"silenceremove=start_periods=1:start_threshold={self.silence_threshold}:start_silence={self.silence_padding}")
+            arguments += ["-af", ",".join(filters)]
+
+        arguments += ["-c:a", "libopus" if self.codec == 'opus' else "libvorbis"]
+
+        if self.bitrate is not None:
+            arguments += ["-b:a", str(self.bitrate)]
+
+        # no random Ogg stream serial and no encoder version tags, so the same
+        # source always gives the same bytes
+        return arguments + ["-fflags", "+bitexact", "-flags:a", "+bitexact", "-f", "ogg"]
+
+
+X264_PRESETS = ('ultrafast', 'superfast', 'veryfast', 'faster', 'fast', 'medium', 'slow', 'slower', 'veryslow')
+
+
+class VideoPreset:
+    """
+    How video is converted to MP4. Files whose first video stream is already
+    H.264 (yuv420p) and whose audio is AAC are remuxed when ``remux`` is on
+    and they fit ``max_size``. Everything else is re-encoded with libx264 at
+    ``crf`` and ``encoder_preset``, scaled down to fit ``max_size``, with AAC
+    audio at ``audio_bitrate``. ``max_duration`` (seconds) cuts long clips
+    either way.
+    """
+
+    __slots__ = ('max_size', 'max_duration', 'crf', 'encoder_preset', 'audio_bitrate', 'remux')
+
+    def __init__(self, max_size=None, max_duration=None, crf=23, encoder_preset='medium', audio_bitrate='128k', remux=True):
+
+        if max_size is not None:
+            max_size = tuple(int(size) for size in max_size)
+            if len(max_size) != 2 or min(max_size) <= 0:
+                raise ValueError("max_size must be a (width, height) pair")
+
+        if max_duration is not None and max_duration <= 0:
+            raise ValueError("max_duration must be positive")
+
+        if not 0 <= crf <= 51:
+            raise ValueError("crf must be between 0 and 51")
+
+        if encoder_preset not in X264_PRESETS:
+            raise ValueError(f"encoder_preset must be one of {', '.join(X264_PRESETS)}")
+
+        self.max_size = max_size
+        self.max_duration = max_duration
+        self.crf = crf
+        self.encoder_preset = encoder_preset
+        self.audio_bitrate = audio_bitrate
+        self.remux = remux
+
+    def to_json(self):
+        return {
+            'max_size': list(self.max_size) if self.max_size is not None else None,
+            'max_duration': self.max_duration,
+            'crf': self.crf,
+            'encoder_preset': self.encoder_preset,
+            'audio_bitrate': self.audio_bitrate,
+            'remux': self.remux,
+        }
+
+    def keeps_mp4(self) -> bool:
+        """
+        True when .mp4 assets can be packaged as they are.
+        """
+        return self.max_size is None and self.max_duration is None
+
+    def can_remux(self, info) -> bool:
+
+        if not self.remux or not info.video:
+            return False
+
+        video = info.video[0]
+        if video['codec'] != 'h264' or video['pixel_format'] != 'yuv420p':
+            return False
+
+        if self.max_size is not None and (video['width'] is None or video['width'] > self.max_size[0] or video['height'] > self.max_size[1]):
+            return False
+
+        return all(audio['codec'] == 'aac' for audio in info.audio[:1])
+
+    def ffmpeg_arguments(self, info):
+
+        arguments = ["-map", "0:v:0", "-map", "0:a:0?"]
+
+        if self.max_duration is not None:
+            arguments += ["-t", str(self.max_duration)]
+
+        if self.can_remux(info):
+            arguments += ["-c", "copy"]
+        else:
+            if self.max_size is not None:
+                width, height = self.max_size
+                scale = f"scale=w='min({width},iw)':h='min({height},ih)':force_original_aspect_ratio=decrease:force_divisible_by=2"
+            else:
+                # yuv420p needs even dimensions
+                scale = "scale=trunc(iw/2)*2:trunc(ih/2)*2"
+
+            arguments += ["-vf", scale, "-c:v", "libx264", "-crf", str(self.crf), "-preset", self.encoder_preset, "-pix_fmt", "yuv420p",
+                          "-c:a", "aac", "-b:a", str(self.audio_bitrate), "-flags:v", "+bitexact", "-flags:a", "+bitexact"]
+
+        # without the muxer's version tags the same source always gives the same bytes
+        return arguments + ["-fflags", "+bitexact", "-movflags", "+faststart", "-f", "mp4"]
+
+
+IMAGE_PRESETS = {
+    'default': ImagePreset(),
+    'photo': ImagePreset(max_size=(1280, 1280), quality=80, method=4),
+    'small': ImagePreset(max_size=(640, 640), quality=75, method=4),
+    'graphic': ImagePreset(lossless=True, method=6),
+}
+
+AUDIO_PRESETS = {
+    'default': AudioPreset(),
+    'speech': AudioPreset(codec='opus', bitrate='32k', sample_rate=48000, channels=1, trim_silence=True),
+    'speech_vorbis': AudioPreset(codec='vorbis', bitrate='48k', sample_rate=32000, channels=1, trim_silence=True),
+    'music': AudioPreset(codec='opus', bitrate='96k', sample_rate=48000),
+}
+
+
+VIDEO_PRESETS = {
+    'default': VideoPreset(),
+    'small': VideoPreset(max_size=(854, 480), crf=28, encoder_preset='veryfast', audio_bitrate='96k'),
+    'clip': VideoPreset(max_size=(1280, 720), max_duration=30, crf=26, encoder_preset='fast'),
+}
+
+
+def _resolve_preset(value, preset_class, presets, kind):
+
+    if value is None:
+        return presets['default']
+
+    if isinstance(value, preset_class):
+        return value
+
+    if isinstance(value, str):
+        if value not in presets:
+            raise ValueError(f"unknown {kind} preset {value}")
+        return presets[value]
+
+    if isinstance(value, dict):
+        options = dict(value)
+        options = {**_resolve_preset(options.pop('preset', None), preset_class, presets, kind).to_json(), **options}
+        try:
+            return preset_class(**options)
+        except TypeError as error:
+            raise ValueError(f"invalid {kind} preset: {error}")
+
+    raise ValueError(f"{kind}_preset must be a preset name or a dict of options")
+
+
+def resolve_image_preset(value) -> ImagePreset:
+    """
+    Resolves a deck or model setting to an ``ImagePreset``: a preset name, a
+    dict of options (optionally based on another preset through its
+    ``preset`` key) or an ``ImagePreset``. None is the default preset.
+    """
+    return _resolve_preset(value, ImagePreset, IMAGE_PRESETS, 'image')
+
+
+def resolve_audio_preset(value) -> AudioPreset:
+    """
+    Same as ``resolve_image_preset``, for ``AudioPreset``.
+    """
+    return _resolve_preset(value, AudioPreset, AUDIO_PRESETS, 'audio')
+
+
+def resolve_video_preset(value) -> VideoPreset:
+    """
+    Same as ``resolve_image_preset``, for ``VideoPreset``.
+    """
+    return _resolve_preset(value, VideoPreset, VIDEO_PRESETS, 'video')
@@ -0,0 +1,170 @@
+import json
+import threading
+import time
+import tracemalloc
+
+
+class StageRecord:
+
+    __slots__ = ('count', 'wall', 'cpu', 'bytes_in', 'bytes_out', 'hits', 'misses')
+
+    def __init__(self):
+        self.count = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.hits = 0
+        self.misses = 0
+
+    def to_json(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class _StageTimer:
+    """
+    Context manager returned by ``BuildProfile.stage``. Callers can set
+    ``bytes_in``, ``bytes_out`` and ``hit`` on it before it exits.
+    """
+
+    __slots__ = ('_profile', '_name', '_wall', '_cpu', 'bytes_in', 'bytes_out', 'hit')
+
+    def __init__(self, profile, name):
+        self._profile = profile
+        self._name = name
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.hit = None
+
+    def __enter__(self):
+        self._wall = time.perf_counter()
+        # per-thread CPU time, stages run concurrently in parallel builds
+        self._cpu = time.thread_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._profile.add(self._name, time.perf_counter() - self._wall, time.thread_time() - self._cpu, self.bytes_in, self.bytes_out, self.hit)
+
+
+class BuildProfile:
+    """
+    Per-stage counters for one deck build: count, wall and CPU time, bytes
+    in and out, and cache hits and misses. Stages nest, so a stage's time
+    includes the stages it runs (a field's time includes its conversion).
+
+    ``track_memory`` also records the tracemalloc peak. tracemalloc is
+    process-wide: when decks are built side by side the peak covers all of
+    them, and only the profile that started tracing stops it.
+    """
+
+    def __init__(self, name, track_memory=False):
+        self.name = name
+        self.stages = {}
+        self._lock = threading.Lock()
+        self._track_memory = track_memory
+        self._owns_tracemalloc = False
+        self._started = None
+        self.wall = 0.0
+        self.memory_peak = None
+
+    def __enter__(self):
+
+        if self._track_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._owns_tracemalloc = True
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        self.wall = time.perf_counter() - self._started
+        if self._track_memory and tracemalloc.is_tracing():
+            self.memory_peak = tracemalloc.get_traced_memory()[1]
+        if self._owns_tracemalloc:
+            tracemalloc.stop()
+            self._owns_tracemalloc = False
+
+    def stage(self, name) -> _StageTimer:
+        return _StageTimer(self, name)
+
+    def add(self, name, wall=0.0, cpu=0.0, bytes_in=0, bytes_out=0, hit=None):
+
+        with self._lock:
+            record = self.stages.get(name)
+            if record is None:
+                record = self.stages[name] = StageRecord()
+
+            record.count += 1
+            record.wall += wall
+            record.cpu += cpu
+            record.bytes_in += bytes_in
+            record.bytes_out += bytes_out
+            if hit is True:
+                record.hits += 1
+            elif hit is False:
+                record.misses += 1
+
+    def to_json(self):
+        return {
+            'deck': self.name,
+            'wall': self.wall,
+            'memory_peak': self.memory_peak,
+            'stages': {name: record.to_json() for name, record in self.stages.items()},
+        }
+
+    def write(self, file_path):
+        with open(file_path, 'w') as file:
+            json.dump(self.to_json(), file, indent=2)
+
+    def report(self) -> str:
+
+        lines = [f"Profile {self.name}: {self.wall:.2f}s"]
+        if self.memory_peak is not None:
+            lines[0] += f", peak memory {self.memory_peak / 1024 / 1024:.1f} MiB"
+
+        lines.append(f"  {'Stage':<24} {'Count':>7} {'Wall':>9} {'CPU':>9} {'In':>10} {'Out':>10} {'Hit/Miss':>10}")
+        for name, record in sorted(self.stages.items(), key=lambda item: -item[1].wall):
+            hits = f"{record.hits}/{record.misses}" if record.hits or record.misses else ""
+            lines.append(f"  {name:<24} {record.count:>7} {record.wall:>8.2f}s {record.cpu:>8.2f}s {_format_bytes(record.bytes_in):>10} {_format_bytes(record.bytes_out):>10} {hits:>10}")
+
+        return "\n".join(lines)
+
+
+class _NullTimer:
+
+    __slots__ = ('bytes_in', 'bytes_out', 'hit')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def __setattr__(self, name, value):
+        pass
+
+
+class NullProfile:
+    """
+    Stand-in used when profiling is off, so instrumented code doesn't have to
+    check for it.
+    """
+
+    _timer = _NullTimer()
+
+    def stage(self, name):
+        return self._timer
+
+    def add(self, name, wall=0.0, cpu=0.0, bytes_in=0, bytes_out=0, hit=None):
+        pass
+
+
+def _format_bytes(size):
+
+    if not size:
+        return ""
+    for unit in ("B", "KiB", "MiB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GiB"
@@ -0,0 +1,218 @@
+import fnmatch
+import json
+import os
+import re
+
+from anki.stream import JsonStreamReader, exhaust
+
+REGISTRY_VERSION = 1
+
+# top-level directories that hold code or build output, never decks
+IGNORED_DIRECTORIES = {"anki", "packages", "temp", "tools"}
+
+_CLASS_PATTERN = re.compile(r"from\s+anki\.fanki\s+import\s+(\w+)")
+
+
+def deck_class_name(main_file_path):
+    """
+    Returns the name of the class the deck's main.py imports from anki.fanki,
+    or None if it doesn't import one.
+    """
+    with open(main_file_path, "r", encoding="utf-8") as file:
+        match = _CLASS_PATTERN.search(file.read())
+    return match.group(1) if match else None
+
+
+def read_deck_metadata(json_file_path) -> dict:
+    """
+    Returns the id and name of a deck file, reading no further than needed
+    when they come before the cards, as they do in every deck we ship.
+    """
+
+    metadata = {}
+    with open(json_file_path, 'r') as file:
+        for key, value in JsonStreamReader(file, chunk_size=64 * 1024).items():
+            if key in ('id', 'name'):
+                metadata[key] = value
+                if len(metadata) == 2:
+                    break
+            elif hasattr(value, '__next__'):
+                exhaust(value)
+    return metadata
+
+
+def _stamp(file_path):
+    try:
+        stat = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class DeckEntry:
+    """
+    A deck directory ``<namespace>/<alias>`` with a data.json and a main.py
+    that imports a deck class from anki.fanki.
+    """
+
+    __slots__ = ('namespace', 'alias', 'path', 'class_name', 'deck_id', 'deck_name')
+
+    def __init__(self, namespace, alias, path, class_name, deck_id=None, deck_name=None):
+        self.namespace = namespace
+        self.alias = alias
+        self.path = path
+        self.class_name = class_name
+        self.deck_id = deck_id
+        self.deck_name = deck_name
+
+    @property
+    def display_name(self) -> str:
+        return f"{self.namespace}/{self.alias}"
+
+    @property
+    def main_file_path(self) -> str:
+        return os.path.join(self.path, "main.py")
+
+    def to_json(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_json(cls, value):
+        return cls(**value)
+
+
+class DeckRegistry:
+    """
+    Index of the decks under ``root_path``, cached in ``index_path``.
+
+    A refresh lists the root again only when its mtime changed, and a
+    namespace only when its own mtime changed, since adding or removing a
+    deck directory updates the mtime of its parent. Each deck's entry is
+    reused while its data.json and main.py keep their size and mtime, so an
+    unchanged tree costs a few stats per deck and no file reads.
+    """
+
+    def __init__(self, root_path, index_path=None):
+
+        if root_path is None or not os.path.isdir(root_path):
+            raise FileNotFoundError(f"root_path folder ({root_path}) not found")
+
+        self._root_path = root_path
+        self._index_path = index_path
+        self._entries = None
+
+    def _load_index(self) -> dict:
+
+        if self._index_path is None or not os.path.isfile(self._index_path):
+            return {}
+
+        try:
+            with open(self._index_path, 'r') as file:
+                index = json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+        if index.get('version') != REGISTRY_VERSION or index.get('root') != self._root_path:
+            return {}
+        return index
+
+    def _save_index(self, index):
+
+        if self._index_path is None:
+            return
+
+        os.makedirs(os.path.dirname(self._index_path), exist_ok=True)
+        tmp_path = f"{self._index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump(index, file)
+        os.replace(tmp_path, self._index_path)
+
+    def refresh(self) -> list:
+
+        index = self._load_index()
+        cached_namespaces = index.get('namespaces', {})
+
+        root_mtime = os.stat(self._root_path).st_mtime_ns
+        if index.get('mtime') == root_mtime:
+            namespace_names = list(cached_namespaces)
+        else:
+            namespace_names = sorted(
+                entry.name for entry in os.scandir(self._root_path)
+                if entry.is_dir() and not entry.name.startswith((".", "_")) and entry.name not in IGNORED_DIRECTORIES
+            )
+
+        namespaces = {}
+        for namespace in namespace_names:
+            namespace_path = os.path.join(self._root_path, namespace)
+            try:
+                namespace_mtime = os.stat(namespace_path).st_mtime_ns
+            except FileNotFoundError:
+                continue
+
+            cached = cached_namespaces.get(namespace, {})
+            if cached.get('mtime') == namespace_mtime:
+                aliases = list(cached.get('decks', {}))
+            else:
+                aliases = sorted(entry.name for entry in os.scandir(namespace_path) if entry.is_dir() and not entry.name.startswith("."))
+
+            decks = {alias: self._deck(namespace, alias, cached.get('decks', {}).get(alias)) for alias in aliases}
+
+            namespaces[namespace] = {'mtime': namespace_mtime, 'decks': decks}
+
+        refreshed = {'version': REGISTRY_VERSION, 'root': self._root_path, 'mtime': root_mtime, 'namespaces': namespaces}
+        if refreshed != index:
+            self._save_index(refreshed)
+
+        self._entries = [
+            DeckEntry.from_json(deck['entry'])
+            for namespace in namespaces.values() for deck in namespace['decks'].values() if deck['entry'] is not None
+        ]
+        return self._entries
+
+    def _deck(self, namespace, alias, cached):
+        """
+        Returns the index record of one directory of a namespace. Directories
+        that aren't decks (no data.json, no main.py or no deck class) are kept
+        with an empty entry, so they aren't read again while unchanged and
+        are picked up once the missing file appears.
+        """
+
+        path = os.path.join(self._root_path, namespace, alias)
+        stamp = [_stamp(os.path.join(path, "data.json")), _stamp(os.path.join(path, "main.py"))]
+
+        if cached is not None and cached.get('stamp') == stamp:
+            return cached
+
+        if None in stamp:
+            return {'stamp': stamp, 'entry': None}
+
+        entry = None
+        class_name = deck_class_name(os.path.join(path, "main.py"))
+        if class_name is not None:
+            try:
+                metadata = read_deck_metadata(os.path.join(path, "data.json"))
+            except ValueError:
+                metadata = {}
+            entry = DeckEntry(namespace, alias, path, class_name, metadata.get('id'), metadata.get('name')).to_json()
+
+        return {'stamp': stamp, 'entry': entry}
+
+    def decks(self) -> list:
+
+        if self._entries is None:
+            self.refresh()
+        return self._entries
+
+    def find(self, pattern=None, namespace=None, alias=None) -> list:
+        """
+        Returns the decks whose "namespace/alias" matches the ``pattern`` glob
+        and whose namespace and alias match the ``namespace`` and ``alias``
+        globs, in namespace and alias order.
+        """
+
+        return [
+            entry for entry in self.decks()
+            if (pattern is None or fnmatch.fnmatch(entry.display_name, pattern))
+            and (namespace is None or fnmatch.fnmatch(entry.namespace, namespace))
+            and (alias is None or fnmatch.fnmatch(entry.alias, alias))
+        ]
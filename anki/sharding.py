@@ -0,0 +1,282 @@
+import glob
+import hashlib
+import json
+import os
+import queue
+import threading
+
+from anki.package import PackageWriter
+
+_CLOSE = object()
+_ABORT = object()
+
+
+class ShardPolicy:
+    """
+    How a deck is split into several packages: a new shard starts once the
+    current one holds ``cards`` notes or ``media_bytes`` bytes of media, or,
+    with ``field``, every distinct value of that model field gets a shard.
+    At most ``max_open`` field shards are written at a time.
+    """
+
+    __slots__ = ('cards', 'media_bytes', 'field', 'max_open')
+
+    def __init__(self, cards=None, media_bytes=None, field=None, max_open=8):
+
+        if cards is None and media_bytes is None and field is None:
+            raise ValueError("cards, media_bytes or field is required")
+
+        if field is not None and (cards is not None or media_bytes is not None):
+            raise ValueError("field can't be combined with cards or media_bytes")
+
+        if cards is not None and cards <= 0:
+            raise ValueError("cards must be positive")
+
+        if media_bytes is not None and media_bytes <= 0:
+            raise ValueError("media_bytes must be positive")
+
+        if max_open <= 0:
+            raise ValueError("max_open must be positive")
+
+        self.cards = cards
+        self.media_bytes = media_bytes
+        self.field = field
+        self.max_open = max_open
+
+    def to_json(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+def resolve_shard_policy(value):
+    """
+    Resolves a deck setting to a ``ShardPolicy``: a card count, a dict of
+    options or a ``ShardPolicy``. None means the deck isn't sharded.
+    """
+
+    if value is None or isinstance(value, ShardPolicy):
+        return value
+
+    if isinstance(value, int) and not isinstance(value, bool):
+        return ShardPolicy(cards=value)
+
+    if isinstance(value, dict):
+        try:
+            return ShardPolicy(**value)
+        except TypeError as error:
+            raise ValueError(f"invalid shards: {error}")
+
+    raise ValueError("shards must be a card count or a dict of options")
+
+
+def shard_deck_id(deck_id, name) -> int:
+    """
+    Id of a shard's subdeck, stable across builds and in the same range as
+    the ids genanki recommends.
+    """
+    digest = hashlib.sha256(f"{deck_id}::{name}".encode()).hexdigest()
+    return (1 << 30) | (int(digest[:8], 16) & ((1 << 30) - 1))
+
+
+class _ShardWriter:
+    """
+    A ``PackageWriter`` fed through a bounded queue from its own thread, so
+    the shards of a deck are written side by side. sqlite connections belong
+    to the thread that opened them, so the writer is created there too.
+    """
+
+    def __init__(self, number, file_path, deck_id, deck_name, model, timestamp=None, max_pending=256):
+
+        self.number = number
+        self.file_path = file_path
+        self.deck_id = deck_id
+        self.deck_name = deck_name
+        self.note_count = 0
+        self.media_bytes = 0
+        self.finished = False
+        self._media_names = set()
+        self._queue = queue.Queue(max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, args=(model, timestamp), name=f"shard-{os.path.basename(file_path)}", daemon=True)
+        self._thread.start()
+
+    def _run(self, model, timestamp):
+
+        writer = None
+        item = None
+        try:
+            writer = PackageWriter(self.file_path, self.deck_id, self.deck_name, model, timestamp)
+            while True:
+                item = self._queue.get()
+                if item is _CLOSE:
+                    writer.close()
+                    return
+                if item is _ABORT:
+                    writer.abort()
+                    return
+
+                method, value = item
+                method(writer, value)
+        except BaseException as error:
+            self._error = error
+            if writer is not None:
+                writer.abort()
+            # keep consuming, so the producer doesn't block on a full queue
+            while item is not _CLOSE and item is not _ABORT:
+                item = self._queue.get()
+
+    def _put(self, item):
+
+        if self._error is not None:
+            raise self._error
+        self._queue.put(item)
+
+    def add_note(self, note):
+        self.note_count += 1
+        self._put((PackageWriter.add_note, note))
+
+    def add_media(self, item):
+
+        if item.name not in self._media_names:
+            item = item.restored()
+            self._media_names.add(item.name)
+            self.media_bytes += len(item.data) if item.data is not None else os.path.getsize(item.path)
+        self._put((PackageWriter.add_media, item))
+
+    def finish(self):
+        """
+        Lets the shard close in the background while the next one fills.
+        """
+        self.finished = True
+        self._queue.put(_CLOSE)
+
+    def wait(self):
+
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def abort(self):
+        self._queue.put(_ABORT)
+        self._thread.join()
+
+
+class ShardedPackageWriter:
+    """
+    Same interface as ``PackageWriter``, but spreads the notes of a deck over
+    ``<base>.partNN.apkg`` packages, each holding a ``Parent::Part N``
+    subdeck (``Parent::<value>`` when sharding by field), and writes an
+    index of the shards and of the shard each note went to in
+    ``<base>.shards.json``.
+
+    Each field shard has its own thread, sqlite database and zip, so only
+    ``policy.max_open`` of them are open at a time. Once a new value finds
+    them all open, the least recently used one is finished, and finished
+    shards still closing count against the limit too. A value that comes
+    back after that goes to a new part of the same subdeck.
+    """
+
+    def __init__(self, index_path, deck_id, deck_name, model, policy, timestamp=None):
+
+        if policy.field is not None and policy.field not in [field['name'] for field in model.fields]:
+            raise ValueError(f"shard field {policy.field} is not a field of the model")
+
+        self._index_path = index_path
+        self._base_path = index_path[:-len(".shards.json")]
+        self._deck_id = deck_id
+        self._deck_name = deck_name
+        self._model = model
+        self._policy = policy
+        self._timestamp = timestamp
+        self._field_index = [field['name'] for field in model.fields].index(policy.field) if policy.field is not None else None
+        self._shards = []
+        self._open_by_value = {}
+        self._closing = []
+        self._current = None
+        self._notes = {}
+
+    @staticmethod
+    def remove(index_path):
+        """
+        Removes the shards and index of a previous build.
+        """
+
+        base_path = index_path[:-len(".shards.json")]
+        for path in glob.glob(glob.escape(base_path) + ".part*.apkg") + [index_path]:
+            if os.path.isfile(path):
+                os.remove(path)
+
+    @property
+    def file_paths(self):
+        return [shard.file_path for shard in self._shards]
+
+    @property
+    def note_count(self):
+        return sum(shard.note_count for shard in self._shards)
+
+    def _open(self, name):
+
+        number = len(self._shards) + 1
+        shard = _ShardWriter(number, f"{self._base_path}.part{number:02d}.apkg", shard_deck_id(self._deck_id, name), f"{self._deck_name}::{name}", self._model, self._timestamp)
+        self._shards.append(shard)
+        return shard
+
+    def _is_full(self, shard) -> bool:
+        return ((self._policy.cards is not None and shard.note_count >= self._policy.cards)
+                or (self._policy.media_bytes is not None and shard.media_bytes >= self._policy.media_bytes))
+
+    def add_note(self, note):
+
+        if self._field_index is not None:
+            value = note.fields[self._field_index].strip() or "Other"
+            # re-inserted below, so the dict stays ordered from least to most recently used
+            self._current = self._open_by_value.pop(value, None)
+            if self._current is None:
+                if len(self._open_by_value) >= self._policy.max_open:
+                    shard = self._open_by_value.pop(next(iter(self._open_by_value)))
+                    shard.finish()
+                    self._closing.append(shard)
+                while self._closing and len(self._open_by_value) + len(self._closing) >= self._policy.max_open:
+                    self._closing.pop(0).wait()
+                self._current = self._open(value)
+            self._open_by_value[value] = self._current
+        elif self._current is None or self._is_full(self._current):
+            if self._current is not None:
+                self._current.finish()
+            self._current = self._open(f"Part {len(self._shards) + 1}")
+
+        self._notes[note.guid] = self._current.number
+        self._current.add_note(note)
+
+    def add_media(self, item):
+        self._current.add_media(item)
+
+    def close(self):
+
+        for shard in self._shards:
+            if not shard.finished:
+                shard.finish()
+        for shard in self._shards:
+            shard.wait()
+
+        index = {
+            'deck': [self._deck_id, self._deck_name],
+            'policy': self._policy.to_json(),
+            'shards': [
+                {'file': os.path.basename(shard.file_path), 'deck': [shard.deck_id, shard.deck_name], 'notes': shard.note_count, 'media_bytes': shard.media_bytes}
+                for shard in self._shards
+            ],
+            'notes': self._notes,
+        }
+
+        tmp_path = self._index_path + ".tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump(index, file, ensure_ascii=False)
+        os.replace(tmp_path, self._index_path)
+
+    def abort(self):
+
+        # shards that were already closed are removed as well
+        for shard in self._shards:
+            shard.abort()
+            if os.path.isfile(shard.file_path):
+                os.remove(shard.file_path)
@@ -0,0 +1,142 @@
+import hashlib
+import os
+
+from anki.cache import source_digest
+
+DEFAULT_MEMORY_THRESHOLD = 1024 * 1024
+
+
+class MediaItem:
+    """
+    A media file as it will be stored in the package: ``name`` is the file
+    name the notes refer to, the payload is either a file on disk (``path``)
+    or an in-memory buffer (``data``). ``rebuild``, when set, produces the
+    payload again if its file is gone.
+    """
+
+    __slots__ = ('name', 'path', 'data', 'rebuild')
+
+    def __init__(self, name, path=None, data=None, rebuild=None):
+
+        if path is None and data is None:
+            raise ValueError("path or data is required")
+
+        self.name = name
+        self.path = path
+        self.data = data
+        self.rebuild = rebuild
+
+    def exists(self) -> bool:
+        return self.data is not None or os.path.isfile(self.path)
+
+    def restored(self):
+        """
+        The item itself, or the one ``rebuild`` returns when its file was
+        removed in the meantime, e.g. a cache payload evicted by another build.
+        """
+
+        if self.rebuild is None or self.exists():
+            return self
+        return self.rebuild()
+
+    def digest(self) -> str:
+
+        if self.data is not None:
+            return hashlib.sha256(self.data).hexdigest()
+        return source_digest(self.path)
+
+    def fingerprint(self):
+        """
+        Changes whenever the payload does, without reading files: the hash of
+        an in-memory buffer, or the path, size and mtime of a file. Converted
+        media live under content-addressed names in the cache, so the stat of
+        a file only matters for assets packaged as they are.
+        """
+
+        if self.data is not None:
+            return self.digest()
+        stat = os.stat(self.path)
+        return [self.path, stat.st_size, stat.st_mtime_ns]
+
+    def to_json(self):
+
+        # in-memory payloads are gone after the build, so they can't be reused
+        if self.path is None:
+            return None
+        return [self.name, self.path]
+
+    @classmethod
+    def from_json(cls, value):
+        name, path = value
+        return cls(name, path=path)
+
+
+class MediaRegistry:
+    """
+    Tracks the media of one build by content hash. The first item seen with
+    a given payload becomes the canonical one, and later items with the same
+    payload under another name resolve to it.
+
+    With a ``shared_prefix`` every item is renamed to ``<prefix>_<hash><ext>``,
+    so decks that share the prefix also share the stored file once imported.
+    """
+
+    def __init__(self, shared_prefix=None):
+        self._shared_prefix = shared_prefix
+        self._items = {}
+
+    def canonical(self, item) -> MediaItem:
+
+        digest = item.digest()
+        canonical = self._items.get(digest)
+
+        if canonical is None:
+            canonical = item
+            if self._shared_prefix is not None:
+                canonical = MediaItem(f"{self._shared_prefix}_{digest[:20]}{os.path.splitext(item.name)[1]}", path=item.path, data=item.data)
+            self._items[digest] = canonical
+
+        return canonical
+
+
+class MediaStage:
+    """
+    Decides where media payloads live until they are packaged. Assets that
+    are already in the right format and cached conversions are referenced in
+    place, without copying. Buffers produced in memory stay there when they
+    are small and are spilled to ``spill_path`` otherwise.
+    """
+
+    def __init__(self, spill_path, memory_threshold=None):
+
+        if spill_path is None:
+            raise ValueError("spill_path is required")
+
+        if memory_threshold is None:
+            memory_threshold = int(os.environ.get("FANKI_STAGE_MEMORY_BYTES", DEFAULT_MEMORY_THRESHOLD))
+
+        self._spill_path = spill_path
+        self._memory_threshold = memory_threshold
+
+    def reference(self, file_path, name=None, rebuild=None) -> MediaItem:
+
+        if not os.path.isfile(file_path):
+            raise FileNotFoundError(f"{file_path} is not a file")
+
+        return MediaItem(name if name is not None else os.path.basename(file_path), path=file_path, rebuild=rebuild)
+
+    def from_bytes(self, name, data) -> MediaItem:
+
+        if len(data) <= self._memory_threshold:
+            return MediaItem(name, data=data)
+
+        if not os.path.isdir(self._spill_path):
+            os.makedirs(self._spill_path, exist_ok=True)
+
+        spill_file_path = os.path.join(self._spill_path, name)
+        tmp_path = f"{spill_file_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as file:
+            file.write(data)
+        os.replace(tmp_path, spill_file_path)
+
+        return MediaItem(name, path=spill_file_path)
@@ -0,0 +1,181 @@
+import json
+
+CHUNK_SIZE = 1024 * 1024
+
+# characters a JSON number can continue with
+_NUMBER_CHARS = "0123456789.eE+-"
+
+
+class JsonStreamReader:
+    """
+    Incremental reader for a deck file shaped like ``{"id": ..., "cards": [...]}``.
+
+    Values are decoded one at a time with ``json.JSONDecoder.raw_decode`` over
+    a sliding buffer, so memory is bounded by the largest single value (one
+    card) instead of the whole file.
+    """
+
+    def __init__(self, file, chunk_size=CHUNK_SIZE):
+        self._file = file
+        self._chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self) -> bool:
+
+        if self._eof:
+            return False
+
+        chunk = self._file.read(self._chunk_size)
+        if not chunk:
+            self._eof = True
+            return False
+
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _peek(self):
+
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos].isspace():
+                self._pos += 1
+
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+
+            if not self._fill():
+                return None
+
+    def _expect(self, char):
+
+        if self._peek() != char:
+            raise ValueError(f"expected '{char}' at offset {self._pos} of the deck file")
+        self._pos += 1
+
+    def _value(self):
+
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+
+            # a number cut by the chunk boundary decodes fine as a shorter one
+            # ("1." as 1, "1.5e" as 1.5), so it is only trusted once something
+            # that can't continue it follows
+            if (isinstance(value, (int, float)) and not isinstance(value, bool)
+                    and not self._buffer[end:].strip(_NUMBER_CHARS) and self._fill()):
+                continue
+
+            self._pos = end
+            return value
+
+    def items(self):
+        """
+        Yields ``(key, value)`` for each top-level key. The value of an array
+        is a generator over its items, which must be consumed (or skipped with
+        ``exhaust``) before asking for the next key.
+        """
+
+        self._expect("{")
+        if self._peek() == "}":
+            return
+
+        while True:
+            key = self._value()
+            self._expect(":")
+
+            if self._peek() == "[":
+                self._pos += 1
+                yield key, self._array_items()
+            else:
+                yield key, self._value()
+
+            char = self._peek()
+            self._pos += 1
+            if char == "}":
+                return
+            if char != ",":
+                raise ValueError(f"expected ',' or '}}' at offset {self._pos} of the deck file")
+
+    def _array_items(self):
+
+        if self._peek() == "]":
+            self._pos += 1
+            return
+
+        while True:
+            yield self._value()
+
+            char = self._peek()
+            self._pos += 1
+            if char == "]":
+                return
+            if char != ",":
+                raise ValueError(f"expected ',' or ']' at offset {self._pos} of the deck file")
+
+
+def exhaust(iterable) -> int:
+
+    count = 0
+    for _ in iterable:
+        count += 1
+    return count
+
+
+def read_deck_header(json_file_path, cards_key='cards') -> dict:
+    """
+    Returns the top-level keys of a deck file. The cards array is skipped
+    and replaced by its length, so the header can be read in constant memory.
+    """
+
+    header = {}
+    with open(json_file_path, 'r') as file:
+        for key, value in JsonStreamReader(file).items():
+            if key == cards_key:
+                header[key] = exhaust(value) if not isinstance(value, list) else len(value)
+            elif hasattr(value, '__next__'):
+                header[key] = list(value)
+            else:
+                header[key] = value
+    return header
+
+
+def iter_deck_cards(json_file_path, cards_key='cards'):
+
+    with open(json_file_path, 'r') as file:
+        for key, value in JsonStreamReader(file).items():
+            if key == cards_key:
+                yield from value
+                return
+            if hasattr(value, '__next__'):
+                exhaust(value)
+
+
+def iter_jsonl_cards(jsonl_file_path):
+
+    with open(jsonl_file_path, 'r') as file:
+        for line in file:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+class CardStream:
+    """
+    Re-iterable view over a card source: every iteration calls ``factory``
+    for a fresh iterator, so each build pass re-reads the file instead of
+    keeping the cards in memory.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+
+    def __iter__(self):
+        return iter(self._factory())
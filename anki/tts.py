@@ -0,0 +1,555 @@
+import hashlib
+import html
+import io
+import json
+import os
+import random
+import re
+import shutil
+import threading
+import time
+import unicodedata
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from anki.cache import ConversionCache
+from anki.ffmpeg import run_ffmpeg
+
+DEFAULT_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+# batched requests: text per request, pause between texts and the PCM rate Polly returns
+DEFAULT_BATCH_CHARS = 1500
+BATCH_GAP_MS = 300
+PCM_SAMPLE_RATE = 16000
+
+
+def normalize_text(text) -> str:
+    """
+    The form text is synthesised and cached under: NFC, with runs of
+    whitespace collapsed and the ends stripped.
+    """
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFC", text)).strip()
+
+
+def tts_key(text, lang, voice, engine, prosody) -> str:
+
+    payload = json.dumps({'text': text, 'lang': lang, 'voice': voice, 'engine': engine, 'prosody': prosody}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def marked_ssml(texts, prosody=False, gap_ms=BATCH_GAP_MS) -> str:
+    """
+    One SSML document speaking ``texts`` in order. Each text is preceded by
+    a mark named after its position and followed by a pause to cut in.
+    """
+
+    body = "".join(f'<mark name="{index}"/>{html.escape(text, quote=False)}<break time="{gap_ms}ms"/>' for index, text in enumerate(texts))
+    if prosody:
+        body = f'<prosody rate="{prosody}">{body}</prosody>'
+    return f"<speak>{body}</speak>"
+
+
+def split_marked_audio(pcm, sample_rate, marks, count, gap_ms=BATCH_GAP_MS) -> list:
+    """
+    Cuts the 16-bit mono PCM of a ``marked_ssml`` request into ``count``
+    clips at the times of the marks, given as ``(name, milliseconds)``. Each
+    clip keeps half of the pause that follows it.
+    """
+
+    times = dict(marks)
+    if any(str(index) not in times for index in range(count)):
+        raise ValueError("speech marks are missing from the response")
+
+    def offset(milliseconds):
+        return max(0, min(len(pcm), int(milliseconds * sample_rate / 1000) * 2))
+
+    clips = []
+    for index in range(count):
+        start = offset(times[str(index)])
+        if index + 1 < count:
+            end = offset(times[str(index + 1)] - gap_ms / 2)
+        else:
+            end = len(pcm) - offset(gap_ms / 2)
+        clips.append(pcm[start:max(start, end)])
+    return clips
+
+
+def _encode_clip(pcm, sample_rate) -> bytes:
+
+    output = io.BytesIO()
+    run_ffmpeg(["-f", "s16le", "-ar", str(sample_rate), "-ac", "1", "-i", "pipe:0", "-c:a", "libvorbis",
+                "-fflags", "+bitexact", "-flags:a", "+bitexact", "-f", "ogg", "pipe:1"], output, input=pcm)
+    return output.getvalue()
+
+
+class TokenBucket:
+    """
+    Blocking token bucket: ``rate`` tokens per second, up to ``capacity``
+    tokens banked for bursts.
+    """
+
+    def __init__(self, rate, capacity=None):
+
+        if rate is None or rate <= 0:
+            raise ValueError("rate must be positive")
+
+        self._rate = float(rate)
+        self._capacity = float(capacity if capacity is not None else rate)
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                wait = (1 - self._tokens) / self._rate
+
+            time.sleep(wait)
+
+
+class PollyBackend:
+
+    # requests a batch costs against the rate limit: the audio and its speech marks
+    batch_requests = 2
+    # requests per second allowed by default
+    default_rate = 8
+
+    voices = {
+        'fr': ['Lea', 'Remi'],
+        'en': ['Matthew', 'Joanna']
+    }
+
+    def __init__(self, profile_name='fer', region_name='us-east-1', engine='neural', max_pool_connections=10):
+        self._profile_name = profile_name
+        self._region_name = region_name
+        self._engine = engine
+        self._max_pool_connections = max_pool_connections
+        self._client = None
+        self._client_lock = threading.Lock()
+
+    @property
+    def name(self) -> str:
+        return f"polly:{self._engine}"
+
+    def voice(self, text, lang='fr') -> str:
+
+        if lang not in self.voices:
+            raise ValueError("lang must exist in voices")
+
+        # picked from the text rather than at random, so a sentence always gets
+        # the same voice and its clip can be cached
+        voices = self.voices[lang]
+        return voices[int(hashlib.md5(text.encode()).hexdigest(), 16) % len(voices)]
+
+    def _get_client(self):
+
+        # boto3 clients are thread safe, sessions are not: build one client and share it
+        with self._client_lock:
+            if self._client is None:
+                import boto3
+                from botocore.config import Config
+
+                session = boto3.Session(profile_name=self._profile_name, region_name=self._region_name)
+                self._client = session.client('polly', config=Config(max_pool_connections=self._max_pool_connections))
+            return self._client
+
+    def synthesize(self, text, lang='fr', prosody=False, voice=None) -> bytes:
+
+        if voice is None:
+            voice = self.voice(text, lang)
+
+        response = self._get_client().synthesize_speech(
+            Engine=self._engine,
+            VoiceId=voice,
+            OutputFormat='ogg_vorbis',
+            Text=f'<speak><prosody rate="{prosody}">{text}</prosody></speak>' if prosody else text,
+            TextType='ssml' if prosody else 'text'
+        )
+
+        return response['AudioStream'].read()
+
+    def synthesize_marked(self, texts, lang='fr', prosody=False, voice=None):
+        """
+        Synthesises ``texts`` in one SSML request and fetches its speech marks
+        with a second one. Returns the audio as 16-bit mono PCM, its sample
+        rate and the ``(name, milliseconds)`` of every mark.
+        """
+
+        if voice is None:
+            voice = self.voice(texts[0], lang)
+
+        ssml = marked_ssml(texts, prosody)
+        client = self._get_client()
+
+        audio = client.synthesize_speech(
+            Engine=self._engine,
+            VoiceId=voice,
+            OutputFormat='pcm',
+            SampleRate=str(PCM_SAMPLE_RATE),
+            Text=ssml,
+            TextType='ssml'
+        )['AudioStream'].read()
+
+        response = client.synthesize_speech(
+            Engine=self._engine,
+            VoiceId=voice,
+            OutputFormat='json',
+            SpeechMarkTypes=['ssml'],
+            Text=ssml,
+            TextType='ssml'
+        )
+        marks = [json.loads(line) for line in response['AudioStream'].read().decode().splitlines() if line.strip()]
+
+        return audio, PCM_SAMPLE_RATE, [(mark['value'], mark['time']) for mark in marks if mark['type'] == 'ssml']
+
+    def is_throttling(self, error) -> bool:
+
+        response = getattr(error, 'response', None)
+        if not isinstance(response, dict):
+            return False
+
+        code = response.get('Error', {}).get('Code')
+        return code in ('ThrottlingException', 'TooManyRequestsException', 'Throttling', 'ServiceUnavailableException')
+
+
+class StubBackend:
+    """
+    Local stand-in for Polly. Returns a deterministic payload per request and
+    records every call, so builds and benchmarks can run without AWS.
+    """
+
+    name = "stub"
+    batch_requests = 1
+    default_rate = None
+
+    def __init__(self, latency=0.0):
+        self._latency = latency
+        self.calls = []
+
+    def voice(self, text, lang='fr') -> str:
+        return "stub"
+
+    def synthesize(self, text, lang='fr', prosody=False, voice=None) -> bytes:
+
+        if self._latency:
+            time.sleep(self._latency)
+
+        self.calls.append((text, lang, prosody))
+        return f"stub:{lang}:{prosody}:{text}".encode()
+
+    def synthesize_marked(self, texts, lang='fr', prosody=False, voice=None):
+        """
+        Silence, 60 ms per character plus the pause after each text, with the
+        marks Polly would return for it.
+        """
+
+        if self._latency:
+            time.sleep(self._latency)
+
+        self.calls.append((tuple(texts), lang, prosody))
+
+        pcm = bytearray()
+        marks = []
+        for index, text in enumerate(texts):
+            marks.append((str(index), len(pcm) // 2 * 1000 // PCM_SAMPLE_RATE))
+            pcm += bytes(2 * (PCM_SAMPLE_RATE * (len(text) * 60 + BATCH_GAP_MS) // 1000))
+        return bytes(pcm), PCM_SAMPLE_RATE, marks
+
+    def is_throttling(self, error) -> bool:
+        return False
+
+
+class TtsEngine:
+    """
+    Runs TTS requests against one backend on a bounded thread pool, with
+    token-bucket rate limiting, throttling retries and de-duplication of
+    identical requests that are still in flight.
+
+    With a ``cache`` (a ``ConversionCache``), clips are stored once under
+    the normalised text, language, voice, backend and prosody, and shared by
+    every deck; ``destination_path`` then becomes optional and requests
+    without one resolve to the cached file.
+
+    With ``batch_size`` above 1, requests for the same language, voice and
+    prosody are grouped, up to ``batch_size`` texts or ``batch_chars``
+    characters, into one SSML request with a mark before each text, and the
+    audio is cut into clips at the marks. A group is sent once it is full
+    or ``batch_linger`` seconds after its first text. Groups that fail are
+    retried one text at a time.
+
+    ``rate`` defaults to the ``default_rate`` of the backend, 0 turns the
+    limit off.
+    """
+
+    def __init__(self, backend=None, concurrency=8, rate=None, burst=None, max_retries=5, backoff=0.5, cache=None,
+                 batch_size=1, batch_chars=DEFAULT_BATCH_CHARS, batch_linger=0.05):
+
+        if backend is None:
+            backend = PollyBackend(max_pool_connections=concurrency)
+
+        if rate is None:
+            rate = getattr(backend, 'default_rate', None)
+
+        self._backend = backend
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="tts")
+        self._bucket = TokenBucket(rate, burst) if rate else None
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._cache = cache
+        self._batch_size = batch_size if hasattr(backend, 'synthesize_marked') else 1
+        self._batch_chars = batch_chars
+        self._batch_linger = batch_linger
+        self._batches = {}
+        self._batches_lock = threading.Lock()
+        self.synthesized = 0
+        self.requests = 0
+
+    @property
+    def backend(self):
+        return self._backend
+
+    @property
+    def cache(self):
+        return self._cache
+
+    def settings(self) -> dict:
+        """
+        What a clip depends on besides its text: the backend and its engine,
+        the voices and whether texts are batched.
+        """
+        return {'backend': self._backend.name, 'voices': getattr(self._backend, 'voices', None), 'batch': self._batch_size > 1}
+
+    def _cache_key(self, text, lang, prosody) -> str:
+        text = normalize_text(text)
+        return tts_key(text, lang, self._backend.voice(text, lang), self._backend.name, prosody)
+
+    def cached(self, text, lang='fr', prosody=False):
+        """
+        Returns the cached clip for this request, or None.
+        """
+
+        if self._cache is None:
+            return None
+        return self._cache.get(self._cache_key(text, lang, prosody))
+
+    def submit(self, text, destination_path=None, lang='fr', prosody=False) -> Future:
+
+        if destination_path is None and self._cache is None:
+            raise ValueError("destination_path must be specified")
+
+        if text == "" or not isinstance(text, str):
+            raise ValueError("text must be specified")
+
+        key = (lang, prosody, text, destination_path)
+
+        with self._pending_lock:
+            future = self._pending.get(key)
+            if future is not None:
+                return future
+
+            if self._batch_size > 1:
+                future = Future()
+            else:
+                future = self._executor.submit(self._synthesize_to_file, text, destination_path, lang, prosody)
+            self._pending[key] = future
+
+        if self._batch_size > 1:
+            self._enqueue(text, destination_path, lang, prosody, future)
+
+        # outside the lock: the callback runs inline if the future is already done
+        future.add_done_callback(lambda _: self._forget(key))
+        return future
+
+    def synthesize(self, text, destination_path=None, lang='fr', prosody=False) -> str:
+        return self.submit(text, destination_path, lang, prosody).result()
+
+    def _forget(self, key):
+        with self._pending_lock:
+            self._pending.pop(key, None)
+
+    def _enqueue(self, text, destination_path, lang, prosody, future):
+
+        # clips that are already cached don't take a place in a batch
+        if self.cached(text, lang, prosody) is not None:
+            self._executor.submit(_run_into, future, self._synthesize_to_file, text, destination_path, lang, prosody)
+            return
+
+        text = normalize_text(text)
+        batch_key = (lang, self._backend.voice(text, lang), prosody)
+
+        with self._batches_lock:
+            batch = self._batches.get(batch_key)
+            if batch is None:
+                batch = self._batches[batch_key] = []
+                timer = threading.Timer(self._batch_linger, self._flush_batch, (batch_key, batch))
+                timer.daemon = True
+                timer.start()
+
+            batch.append((text, destination_path, future))
+            full = len(batch) >= self._batch_size or sum(len(item[0]) for item in batch) >= self._batch_chars
+            if full:
+                del self._batches[batch_key]
+
+        if full:
+            self._executor.submit(self._synthesize_batch, batch_key, batch)
+
+    def _flush_batch(self, batch_key, batch):
+
+        with self._batches_lock:
+            if self._batches.get(batch_key) is not batch:
+                return
+            del self._batches[batch_key]
+
+        self._executor.submit(self._synthesize_batch, batch_key, batch)
+
+    def flush(self):
+        """
+        Sends the batches that are still waiting to fill up.
+        """
+
+        with self._batches_lock:
+            batches = list(self._batches.items())
+            self._batches.clear()
+
+        for batch_key, batch in batches:
+            self._executor.submit(self._synthesize_batch, batch_key, batch)
+
+    def _synthesize_batch(self, batch_key, batch):
+
+        lang, voice, prosody = batch_key
+        texts = [text for text, _, _ in batch]
+
+        try:
+            pcm, sample_rate, marks = self._with_retries(lambda: self._backend.synthesize_marked(texts, lang=lang, prosody=prosody, voice=voice), self._backend.batch_requests)
+            clips = split_marked_audio(pcm, sample_rate, marks, len(texts))
+        except Exception:
+            for text, destination_path, future in batch:
+                self._executor.submit(_run_into, future, self._synthesize_to_file, text, destination_path, lang, prosody)
+            return
+
+        with self._pending_lock:
+            self.synthesized += len(texts)
+            self.requests += self._backend.batch_requests
+
+        for (text, destination_path, future), clip in zip(batch, clips):
+            _run_into(future, lambda: self._store(text, destination_path, lang, voice, prosody, _encode_clip(clip, sample_rate)))
+
+    def _synthesize_to_file(self, text, destination_path, lang, prosody) -> str:
+
+        text = normalize_text(text)
+        voice = self._backend.voice(text, lang)
+
+        payload_path = self._cache.get(tts_key(text, lang, voice, self._backend.name, prosody)) if self._cache is not None else None
+        if payload_path is not None:
+            return self._deliver(payload_path, destination_path)
+
+        audio = self._with_retries(lambda: self._backend.synthesize(text, lang=lang, prosody=prosody, voice=voice))
+        with self._pending_lock:
+            self.synthesized += 1
+            self.requests += 1
+
+        return self._store(text, destination_path, lang, voice, prosody, audio)
+
+    def _store(self, text, destination_path, lang, voice, prosody, audio) -> str:
+
+        if self._cache is None:
+            tmp_path = f"{destination_path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as file:
+                file.write(audio)
+            os.replace(tmp_path, destination_path)
+            return destination_path
+
+        return self._deliver(self._cache.put_bytes(tts_key(text, lang, voice, self._backend.name, prosody), ".ogg", audio), destination_path)
+
+    def _deliver(self, payload_path, destination_path) -> str:
+
+        if destination_path is None:
+            return payload_path
+
+        tmp_path = f"{destination_path}.{threading.get_ident()}.tmp"
+        shutil.copyfile(payload_path, tmp_path)
+        os.replace(tmp_path, destination_path)
+        return destination_path
+
+    def _with_retries(self, request, tokens=1):
+
+        attempt = 0
+        while True:
+            if self._bucket is not None:
+                for _ in range(tokens):
+                    self._bucket.acquire()
+
+            try:
+                return request()
+            except Exception as error:
+                if attempt >= self._max_retries or not self._backend.is_throttling(error):
+                    raise
+                time.sleep(self._backoff * (2 ** attempt) * (1 + random.random()))
+                attempt += 1
+
+    def shutdown(self, wait=True):
+        self.flush()
+        self._executor.shutdown(wait=wait)
+
+
+def _run_into(future, function, *args):
+
+    try:
+        future.set_result(function(*args))
+    except BaseException as error:
+        future.set_exception(error)
+
+
+_default_engine = None
+_default_engine_lock = threading.Lock()
+
+
+def get_engine() -> TtsEngine:
+    """
+    Shared engine for the process, configured from FANKI_TTS_BACKEND
+    (polly or stub), FANKI_TTS_CONCURRENCY and FANKI_TTS_RATE (8 requests
+    per second for Polly, no limit for the stub by default). Clips are
+    cached in FANKI_TTS_CACHE_PATH (temp/tts by default) up to
+    FANKI_TTS_CACHE_MAX_BYTES; FANKI_TTS_CACHE=0 turns the cache off.
+    FANKI_TTS_BATCH above 1 batches up to that many texts per request.
+    """
+
+    global _default_engine
+
+    with _default_engine_lock:
+        if _default_engine is None:
+            concurrency = int(os.environ.get("FANKI_TTS_CONCURRENCY", 8))
+            rate = float(os.environ["FANKI_TTS_RATE"]) if os.environ.get("FANKI_TTS_RATE") else None
+
+            if os.environ.get("FANKI_TTS_BACKEND", "polly") == "stub":
+                backend = StubBackend()
+            else:
+                backend = PollyBackend(max_pool_connections=concurrency)
+
+            cache = None
+            if os.environ.get("FANKI_TTS_CACHE", "1") != "0":
+                cache_path = os.environ.get("FANKI_TTS_CACHE_PATH") or os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "temp", "tts")
+                cache = ConversionCache(cache_path, max_bytes=int(os.environ.get("FANKI_TTS_CACHE_MAX_BYTES", DEFAULT_CACHE_MAX_BYTES)))
+
+            batch_size = int(os.environ.get("FANKI_TTS_BATCH", 1))
+            _default_engine = TtsEngine(backend=backend, concurrency=concurrency, rate=rate, cache=cache, batch_size=batch_size)
+
+        return _default_engine
+
+
+def set_engine(engine):
+
+    global _default_engine
+
+    with _default_engine_lock:
+        _default_engine = engine
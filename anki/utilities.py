@@ -1,11 +1,10 @@
-import random
-import boto3
 import os
 
-import genanki
-from PIL import Image
+from anki.tts import get_engine
 
 def convert_to_webp(input_image_path, output_image_path):
+    from PIL import Image
+
     image = Image.open(input_image_path)
     image.save(output_image_path, 'webp')
 
@@ -22,39 +21,7 @@ def text_to_strings(source_file):
 
 def text_to_ogg(lang='fr', text="", destination_path=None, prosody=False) -> str:
 
-    voices = {
-        'fr': ['Lea', 'Remi'],
-        'en': ['Matthew', 'Joanna']
-    }
-
-    # if lang exist in voices
-    if lang not in voices:
-        raise ValueError("lang must exist in voices")
-
-    if destination_path is None:
-        raise ValueError("destination_path must be specified")
-
-    if text == "" or not isinstance(text, str):
-        raise ValueError("text must be specified")
-
-    session = boto3.Session(profile_name='fer', region_name='us-east-1')
-    polly_client = session.client('polly')
-
-    # get rando voice from voices
-    voice = random.choice(voices[lang])
-
-    response = polly_client.synthesize_speech(
-        Engine='neural',
-        VoiceId=voice,
-        OutputFormat='ogg_vorbis',
-        Text=f'<speak><prosody rate="{prosody}">{text}</prosody></speak>' if prosody else text,
-        TextType='ssml' if prosody else 'text'
-    )
-
-    with open(destination_path, 'wb') as file:
-        file.write(response['AudioStream'].read())
-
-    return destination_path
+    return get_engine().synthesize(text=text, destination_path=destination_path, lang=lang, prosody=prosody)
 
 def package_location():
 
@@ -69,4 +36,6 @@ def generate(deck, source_file):
     basename = os.path.basename(source_file)
 
     print(f"Generating deck {namespace}/{basename}... ")
+    import genanki
+
     genanki.Package(deck).write_to_file(text_to_strings(source_file))
\ No newline at end of file
@@ -0,0 +1,105 @@
+import os
+import time
+
+
+class DeckWatcher:
+    """
+    Polls deck directories for changes to data.json, cards.jsonl and the
+    files in assets/, and calls ``build(name, changes)`` once a deck has been
+    quiet for ``debounce`` seconds. Polling keeps it free of platform
+    specific file system APIs; a snapshot is one walk of assets/, which
+    skips the same files as ``anki.assets.AssetIndex``.
+
+    ``decks`` maps a display name to a deck directory. ``changes`` lists
+    the added, modified and removed paths, relative to the deck directory.
+    """
+
+    def __init__(self, decks, build, interval=0.5, debounce=0.5):
+
+        if not decks:
+            raise ValueError("decks is required")
+
+        self._decks = dict(decks)
+        self._build = build
+        self._interval = interval
+        self._debounce = debounce
+        self._snapshots = {name: self.snapshot(path) for name, path in self._decks.items()}
+        self._pending = {}
+
+    @staticmethod
+    def snapshot(deck_path) -> dict:
+
+        files = {}
+        for file_name in ("data.json", "cards.jsonl"):
+            file_path = os.path.join(deck_path, file_name)
+            if os.path.isfile(file_path):
+                stat = os.stat(file_path)
+                files[file_name] = (stat.st_size, stat.st_mtime_ns)
+
+        assets_path = os.path.join(deck_path, "assets")
+        for directory, directories, file_names in os.walk(assets_path):
+            directories[:] = [name for name in directories if not name.startswith(".")]
+            prefix = os.path.relpath(directory, assets_path).replace(os.sep, "/")
+            prefix = "assets/" if prefix == "." else f"assets/{prefix}/"
+            for file_name in file_names:
+                # hidden files and temporary files of writes still in progress
+                if file_name.startswith(".") or file_name.endswith(".tmp"):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(directory, file_name))
+                except FileNotFoundError:
+                    continue
+                files[prefix + file_name] = (stat.st_size, stat.st_mtime_ns)
+
+        return files
+
+    @staticmethod
+    def diff(before, after) -> dict:
+        return {
+            'added': sorted(after.keys() - before.keys()),
+            'modified': sorted(path for path in after.keys() & before.keys() if after[path] != before[path]),
+            'removed': sorted(before.keys() - after.keys()),
+        }
+
+    def poll(self) -> list:
+        """
+        Takes one round of snapshots and builds the decks whose changes have
+        settled. Returns the names of the decks built.
+        """
+
+        now = time.monotonic()
+        built = []
+
+        for name, deck_path in self._decks.items():
+            snapshot = self.snapshot(deck_path)
+            pending = self._pending.get(name)
+
+            if pending is None:
+                if snapshot != self._snapshots[name]:
+                    self._pending[name] = (snapshot, now)
+                continue
+
+            # still changing: wait for the edits to settle
+            if snapshot != pending[0]:
+                self._pending[name] = (snapshot, now)
+                continue
+
+            if now - pending[1] < self._debounce:
+                continue
+
+            changes = self.diff(self._snapshots[name], snapshot)
+            # the snapshot is taken before building, so files the build writes
+            # itself show up as a change once more and end in a no-op build
+            self._snapshots[name] = snapshot
+            del self._pending[name]
+
+            self._build(name, changes)
+            built.append(name)
+
+        return built
+
+    def run(self):
+
+        while True:
+            self.poll()
+            time.sleep(self._interval)
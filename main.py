@@ -1,69 +1,233 @@
 import os
 import ast
-import re
+import sys
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-import questionary
 import subprocess
 
-def check_import_and_variable(file_path, library, variable_name):
+def find_decks(pattern=None, namespace=None, alias=None):
     """
-    Checks if the file at `file_path` imports the specified library
-    and defines the given variable.
+    Returns a dict of "namespace/alias" display names to deck main.py paths,
+    for the decks matching the globs. Decks come from the registry cached in
+    temp/decks.json, which only re-reads directories that changed.
+    """
+    from anki.registry import DeckRegistry
+
+    root_path = os.path.dirname(os.path.abspath(__file__))
+    registry = DeckRegistry(root_path, os.path.join(root_path, "temp", "decks.json"))
+    return {entry.display_name: entry.main_file_path for entry in registry.find(pattern, namespace, alias)}
+
+
+def load_deck(display_name, main_file_path):
+    """
+    Imports a deck with the class its main.py uses, without running main.py.
+    """
+    import anki.fanki
+    from anki.registry import deck_class_name
+
+    class_name = deck_class_name(main_file_path)
+    deck_class = getattr(anki.fanki, class_name or "", None)
+    if deck_class is None:
+        raise ValueError(f"{display_name}/main.py does not import a deck class from anki.fanki")
+
+    return deck_class.import_deck(os.path.dirname(main_file_path))
+
+
+def build_deck(display_name, main_file_path, jobs, process_pool, force=False, thread_pool=None):
+    """
+    Imports and generates one deck in this process. Returns the elapsed time.
+    """
+    start = time.perf_counter()
+    deck = load_deck(display_name, main_file_path)
+    deck.generate(jobs=jobs, force=force, process_pool=process_pool, thread_pool=thread_pool)
+    return time.perf_counter() - start
+
+
+def build_decks(files_info, jobs, force=False):
+    """
+    Builds several decks in parallel, sharing one process pool for the media
+    conversions and one thread pool for the cards, and prints the time spent
+    on each deck.
+    """
+    results = {}
+
+    # each deck would otherwise open jobs * 4 threads of its own, jobs decks at a time
+    with ProcessPoolExecutor(max_workers=jobs) as process_pool, ThreadPoolExecutor(max_workers=jobs * 4) as card_pool, ThreadPoolExecutor(max_workers=jobs) as deck_pool:
+        futures = {
+            display_name: deck_pool.submit(build_deck, display_name, main_file_path, jobs, process_pool, force, card_pool)
+            for display_name, main_file_path in files_info.items()
+        }
+
+        for display_name, future in futures.items():
+            try:
+                results[display_name] = (future.result(), None)
+            except Exception as error:
+                results[display_name] = (None, error)
+
+    print("")
+    print(f"{'Deck':<40} {'Time':>10}")
+    for display_name, (elapsed, error) in results.items():
+        status = f"{elapsed:>9.2f}s" if error is None else f"failed: {error}"
+        print(f"{display_name:<40} {status:>10}")
+
+    return all(error is None for _, error in results.values())
+
+
+def watch_decks(files_info, jobs):
+    """
+    Builds the decks, then rebuilds each one whenever its data.json or assets
+    change. The process pool, the TTS engine and the digest memo stay warm
+    between rebuilds, and the build manifest limits each rebuild to the
+    cards whose content or assets changed.
+    """
+    from anki.profiling import BuildProfile
+    from anki.watch import DeckWatcher
+
+    decks = {display_name: os.path.dirname(main_file_path) for display_name, main_file_path in files_info.items()}
+
+    with ProcessPoolExecutor(max_workers=jobs) as process_pool:
+
+        def build(display_name, changes=None):
+            summary = ", ".join(f"{len(paths)} {kind}" for kind, paths in (changes or {}).items() if paths)
+            profile = BuildProfile(display_name)
+            try:
+                with profile:
+                    deck = load_deck(display_name, files_info[display_name])
+                    deck.generate(jobs=jobs, process_pool=process_pool, profile=profile)
+            except Exception as error:
+                print(f"[{time.strftime('%H:%M:%S')}] {display_name}: failed: {error}")
+                return
+
+            parsed = profile.stages.get("parse_card")
+            cards = f", {parsed.misses} cards parsed, {parsed.hits} reused" if parsed is not None else ", up to date"
+            print(f"[{time.strftime('%H:%M:%S')}] {display_name}: {summary + ' -> ' if summary else ''}built in {profile.wall:.2f}s{cards}")
 
-    Returns True if both conditions are met, False otherwise.
+        for display_name in decks:
+            build(display_name)
+
+        print(f"Watching {len(decks)} deck(s), press Ctrl+C to stop.")
+        try:
+            DeckWatcher(decks, build).run()
+        except KeyboardInterrupt:
+            pass
+
+
+def check_decks(files_info):
     """
-    with open(file_path, "r", encoding="utf-8") as file:
-        content = file.read()
+    Checks the assets of the decks without building them. Returns False if
+    any deck references a missing asset.
+    """
+    ok = True
+    for display_name, main_file_path in files_info.items():
+        report = load_deck(display_name, main_file_path).check_assets()
+        print(report.summary(display_name))
+        ok = ok and report.ok
+    return ok
+
 
-    # Check if the file imports the library
-    import_pattern = r"from\s+.+\s+import\s+{0}".format(library)
-    imports_library = re.search(import_pattern, content) is not None
+def prewarm_tts(files_info):
+    """
+    Synthesises the TTS clips the decks are missing into the shared TTS
+    cache, so the builds that follow only read it.
+    """
+    from anki.tts import get_engine
 
-    # Check if the file defines the variable
-    variable_pattern = r"{0}\s*=\s*.+".format(variable_name)
-    variable_defined = re.search(variable_pattern, content) is not None
+    print(f"{'Deck':<40} {'Clips':>10}")
+    for display_name, main_file_path in files_info.items():
+        deck = load_deck(display_name, main_file_path)
+        print(f"{display_name:<40} {deck.prewarm_tts():>10}")
 
-    return imports_library and variable_defined
+    engine = get_engine()
+    print(f"{engine.synthesized} clips synthesised in {engine.requests} requests")
 
 
-def list_sibling_directories():
+def print_tts_stats():
     """
-    List all directories that are in the same level as the executed file,
-    excluding those starting with '.' and named 'anki'.
+    Prints the size of the shared TTS cache.
     """
-    executed_file_directory = os.path.dirname(os.path.abspath(__file__))
-    all_entries = os.listdir(executed_file_directory)
+    from anki.tts import get_engine
+
+    cache = get_engine().cache
+    if cache is None:
+        print("The TTS cache is disabled (FANKI_TTS_CACHE=0).")
+        return
 
-    sibling_directories = [entry for entry in all_entries
-                           if os.path.isdir(os.path.join(executed_file_directory, entry))
-                           and not entry.startswith(".")
-                           and entry != "anki"
-                           and not entry.startswith("_")]
+    stats = cache.stats()
+    print(f"TTS cache {stats['path']}")
+    print(f"  {stats['entries']} clips, {stats['bytes'] / 1024 / 1024:.1f} MiB of {stats['max_bytes'] / 1024 / 1024:.0f} MiB")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Build Anki decks.")
+    parser.add_argument("--all", action="store_true", help="build every deck without prompting")
+    parser.add_argument("--filter", metavar="GLOB", help="build the decks whose namespace/alias matches GLOB")
+    parser.add_argument("--namespace", metavar="GLOB", help="build the decks whose namespace matches GLOB")
+    parser.add_argument("--alias", metavar="GLOB", help="build the decks whose alias matches GLOB")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="worker processes shared by all decks")
+    parser.add_argument("--force", action="store_true", help="rebuild even if the build manifest is up to date")
+    parser.add_argument("--profile", nargs="?", const="1", metavar="DIR",
+                        help="print a per-stage report for each deck, or write it as JSON into DIR")
+    parser.add_argument("--profile-memory", action="store_true", help="also track the tracemalloc peak while profiling")
+    parser.add_argument("--delta", action="store_true", help="also write a .delta.apkg with only the notes changed since the previous build")
+    parser.add_argument("--watch", action="store_true", help="rebuild the selected decks (all by default) whenever their data.json or assets change")
+    parser.add_argument("--check", action="store_true", help="report missing, unreferenced and unsupported assets of the selected decks (all by default) and exit")
+    parser.add_argument("--tts-prewarm", action="store_true", help="synthesise the missing TTS clips of the selected decks (all by default) and exit")
+    parser.add_argument("--tts-batch", type=int, metavar="N", help="synthesise up to N short texts per TTS request, cut apart at SSML marks")
+    parser.add_argument("--tts-stats", action="store_true", help="print the size of the shared TTS cache and exit")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    # decks import anki.fanki relative to the repository root
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    if args.tts_stats:
+        print_tts_stats()
+        return
 
-    return sibling_directories
+    selected = args.filter or args.namespace or args.alias
+    files_info = find_decks(args.filter, args.namespace, args.alias)
 
+    # passed through the environment so decks run as a subprocess are profiled too
+    if args.profile:
+        os.environ["FANKI_PROFILE"] = os.path.abspath(args.profile) if args.profile != "1" else "1"
+        if args.profile_memory:
+            os.environ["FANKI_PROFILE_MEMORY"] = "1"
 
-def main():
-    files_info = {}
-    directories = list_sibling_directories()
+    if args.delta:
+        os.environ["FANKI_DELTA"] = "1"
 
-    for directory in directories:
-        dir_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), directory)
-        for subdirectory in os.listdir(dir_path):
-            subdirectory_path = os.path.join(dir_path, subdirectory)
-            if os.path.isdir(subdirectory_path):
-                main_file_path = os.path.join(subdirectory_path, 'main.py')
-                if os.path.isfile(main_file_path):
-                    value = check_import_and_variable(main_file_path, 'FankiModelDefault', 'deck')
-                    if value is not None:
-                        # Combine the directory name and subdirectory name for display
-                        display_name = f"{directory}/{subdirectory}"
-                        files_info[display_name] = main_file_path
+    if args.tts_batch:
+        os.environ["FANKI_TTS_BATCH"] = str(args.tts_batch)
 
     if not files_info:
-        print("No files found matching the criteria.")
+        print("No decks match the filter." if selected else "No files found matching the criteria.")
         return
 
+    if args.all or selected or args.check or args.tts_prewarm or args.watch:
+        if args.check:
+            if not check_decks(files_info):
+                sys.exit(1)
+            return
+
+        if args.tts_prewarm:
+            prewarm_tts(files_info)
+            return
+
+        if args.watch:
+            watch_decks(files_info, max(1, args.jobs))
+            return
+
+        if not build_decks(files_info, max(1, args.jobs), args.force):
+            sys.exit(1)
+        return
+
+    import questionary
+
     # We use questionary to allow the user to select a file, displaying directory and name
     display_name_to_execute = questionary.select(
         "Choose a file to execute:",
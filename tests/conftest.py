@@ -0,0 +1,5 @@
+from pathlib import Path
+import sys
+
+# the tests import the anki package from the repository root
+sys.path.append(str(Path(__file__).resolve().parent.parent))
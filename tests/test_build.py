@@ -0,0 +1,96 @@
+import io
+import json
+import os
+import subprocess
+import zipfile
+
+import pytest
+
+from anki import tts
+from anki.cache import ConversionCache
+from anki.fanki import FankiModelDefault
+from anki.ffmpeg import ffmpeg_executable
+
+
+def _has_ffmpeg() -> bool:
+    try:
+        ffmpeg_executable()
+        return True
+    except FileNotFoundError:
+        return False
+
+
+pytestmark = pytest.mark.skipif(not _has_ffmpeg(), reason="ffmpeg is needed to convert the assets")
+
+
+class VideoDeck(FankiModelDefault):
+
+    def _setup(self):
+        super()._setup()
+        self._f_model.add_field('back_video')
+
+    def _card_from_data(self, card) -> dict:
+        return {**super()._card_from_data(card), 'back_video': card.get('back_video')}
+
+
+def _ffmpeg(*arguments):
+    subprocess.run([ffmpeg_executable(), "-nostdin", "-loglevel", "error", "-y", *arguments], check=True)
+
+
+@pytest.fixture
+def deck_path(tmp_path):
+    from PIL import Image
+
+    deck_path = tmp_path / "decks" / "test" / "build"
+    assets_path = deck_path / "assets"
+    assets_path.mkdir(parents=True)
+
+    Image.new('RGB', (64, 48), "#3366cc").save(assets_path / "chaise.png")
+    _ffmpeg("-f", "lavfi", "-i", "sine=frequency=440:duration=1", str(assets_path / "chaise.wav"))
+    _ffmpeg("-f", "lavfi", "-i", "testsrc=duration=1:size=64x48:rate=10", "-f", "lavfi", "-i", "sine=duration=1",
+            "-c:v", "mpeg4", "-c:a", "libvorbis", "-shortest", str(assets_path / "chaise.mkv"))
+
+    cards = [{
+        'front': f"chaise {number}",
+        'front_image': "assets/chaise.png",
+        'back': f"Une chaise {number}",
+        'back_tts': True,
+        'back_audio': "assets/chaise.wav" if number % 2 else None,
+        'back_video': "assets/chaise.mkv" if number == 1 else None,
+    } for number in range(6)]
+
+    (deck_path / "data.json").write_text(json.dumps({'id': 1234, 'name': "Build", 'cards': cards}))
+    return deck_path
+
+
+def _build(deck_path, scratch_path, jobs, monkeypatch):
+
+    for name in ("packages", "temp"):
+        (scratch_path / name).mkdir(parents=True)
+    monkeypatch.setenv("FANKI_PACKAGES_PATH", str(scratch_path / "packages"))
+    monkeypatch.setenv("FANKI_TEMP_PATH", str(scratch_path / "temp"))
+
+    # a cold TTS cache of its own, with batching so the clips go through ffmpeg too
+    engine = tts.TtsEngine(backend=tts.StubBackend(), cache=ConversionCache(str(scratch_path / "tts")), batch_size=4)
+    tts.set_engine(engine)
+    try:
+        with open(VideoDeck.import_deck(str(deck_path)).generate(jobs=jobs, force=True), 'rb') as file:
+            return file.read()
+    finally:
+        engine.shutdown()
+        tts.set_engine(None)
+
+
+@pytest.mark.parametrize("cache", ["1", "0"])
+def test_parallel_build_is_byte_identical_to_serial_build(deck_path, tmp_path, monkeypatch, cache):
+
+    monkeypatch.setenv("FANKI_CACHE", cache)
+
+    serial = _build(deck_path, tmp_path / "serial", 1, monkeypatch)
+    parallel = _build(deck_path, tmp_path / "parallel", 3, monkeypatch)
+
+    assert serial == parallel
+
+    with zipfile.ZipFile(io.BytesIO(serial)) as package:
+        media_names = json.loads(package.read('media')).values()
+    assert {os.path.splitext(name)[1] for name in media_names} == {".webp", ".ogg", ".mp4"}
@@ -0,0 +1,49 @@
+import os
+
+from anki.cache import ConversionCache
+
+
+def _write(data):
+
+    def encoder(_source_path, destination_path):
+        with open(destination_path, 'wb') as file:
+            file.write(data)
+
+    return encoder
+
+
+def test_put_keeps_a_payload_larger_than_the_cache(tmp_path):
+
+    cache = ConversionCache(str(tmp_path), max_bytes=10, grace=0)
+
+    payload_path = cache.put("a" * 64, ".bin", _write(b"x" * 100), None)
+
+    assert os.path.isfile(payload_path)
+    assert cache.get("a" * 64) == payload_path
+
+
+def test_evict_removes_least_recently_used_first(tmp_path):
+
+    cache = ConversionCache(str(tmp_path), max_bytes=25, grace=0)
+
+    first = cache.put_bytes("a" * 64, ".bin", b"x" * 10)
+    second = cache.put_bytes("b" * 64, ".bin", b"x" * 10)
+    assert cache.get("a" * 64) == first
+
+    cache.put_bytes("c" * 64, ".bin", b"x" * 10)
+
+    assert os.path.isfile(first)
+    assert not os.path.isfile(second)
+    assert cache.get("b" * 64) is None
+
+
+def test_evict_leaves_entries_in_their_grace_period(tmp_path):
+
+    cache = ConversionCache(str(tmp_path), max_bytes=15)
+
+    first = cache.put_bytes("a" * 64, ".bin", b"x" * 10)
+    second = cache.put_bytes("b" * 64, ".bin", b"x" * 10)
+    cache.evict()
+
+    assert os.path.isfile(first) and os.path.isfile(second)
+    assert cache.stats()['entries'] == 2
@@ -0,0 +1,53 @@
+import subprocess
+
+import pytest
+
+from anki.fanki import _encode_ogg
+from anki.ffmpeg import ffmpeg_executable, probe, trailing_silence
+from anki.presets import AudioPreset
+
+
+def _has_ffmpeg() -> bool:
+    try:
+        ffmpeg_executable()
+        return True
+    except FileNotFoundError:
+        return False
+
+
+pytestmark = pytest.mark.skipif(not _has_ffmpeg(), reason="ffmpeg is needed to decode the clips")
+
+
+def _clip(path, *parts):
+    """
+    Writes a mono wav of ``parts``, ("tone" or "silence", seconds) pairs.
+    """
+
+    arguments = []
+    for kind, seconds in parts:
+        source = f"sine=d={seconds}:r=44100" if kind == "tone" else f"anullsrc=d={seconds}:r=44100:cl=mono"
+        arguments += ["-f", "lavfi", "-i", source]
+
+    inputs = "".join(f"[{index}]" for index in range(len(parts)))
+    subprocess.run([ffmpeg_executable(), "-nostdin", "-loglevel", "error", "-y", *arguments,
+                    "-filter_complex", f"{inputs}concat=n={len(parts)}:v=0:a=1", str(path)], check=True)
+    return str(path)
+
+
+def test_trailing_silence(tmp_path):
+
+    padded = _clip(tmp_path / "padded.wav", ("silence", 1), ("tone", 0.5), ("silence", 1), ("tone", 0.5), ("silence", 1.5))
+    assert trailing_silence(padded, "-50dB") == pytest.approx(3.0, abs=0.01)
+
+    tight = _clip(tmp_path / "tight.wav", ("silence", 1), ("tone", 1))
+    assert trailing_silence(tight, "-50dB") is None
+
+
+def test_trim_keeps_pauses(tmp_path):
+
+    source = _clip(tmp_path / "padded.wav", ("silence", 1), ("tone", 0.5), ("silence", 1), ("tone", 0.5), ("silence", 1.5))
+    destination = str(tmp_path / "trimmed.ogg")
+    _encode_ogg(source, destination, AudioPreset(trim_silence=True, silence_padding=0.1))
+
+    # 0.1s kept on each side of the 2s from the first tone to the end of the last one
+    assert probe(destination).duration == pytest.approx(2.2, abs=0.05)
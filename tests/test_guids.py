@@ -0,0 +1,91 @@
+import json
+import os
+import shutil
+import sqlite3
+import zipfile
+
+import genanki
+import pytest
+
+from anki import tts
+from anki.cache import ConversionCache
+from anki.fanki import FankiModelDefault
+from anki.ffmpeg import ffmpeg_executable
+
+
+def _has_ffmpeg() -> bool:
+    try:
+        ffmpeg_executable()
+        return True
+    except FileNotFoundError:
+        return False
+
+
+pytestmark = pytest.mark.skipif(not _has_ffmpeg(), reason="ffmpeg is needed to encode the TTS clips")
+
+
+def _write_cards(deck_path, backs):
+    cards = [{'front': f"mot {number}", 'back': back} for number, back in enumerate(backs)]
+    (deck_path / "data.json").write_text(json.dumps({'id': 1234, 'name': "Guids", 'cards': cards}))
+
+
+def _guids(package_path) -> dict:
+
+    with zipfile.ZipFile(package_path) as package:
+        collection = os.path.join(os.path.dirname(package_path), "collection.anki2")
+        with open(collection, 'wb') as file:
+            file.write(package.read('collection.anki2'))
+
+    conn = sqlite3.connect(collection)
+    try:
+        return {fields.split("\x1f")[0]: guid for guid, fields in conn.execute("SELECT guid, flds FROM notes")}
+    finally:
+        conn.close()
+        os.remove(collection)
+
+
+@pytest.fixture
+def build(tmp_path, monkeypatch):
+
+    deck_path = tmp_path / "decks" / "test" / "guids"
+    (deck_path / "assets").mkdir(parents=True)
+    for name in ("packages", "temp"):
+        (tmp_path / name).mkdir()
+    monkeypatch.setenv("FANKI_PACKAGES_PATH", str(tmp_path / "packages"))
+    monkeypatch.setenv("FANKI_TEMP_PATH", str(tmp_path / "temp"))
+
+    engine = tts.TtsEngine(backend=tts.StubBackend(), cache=ConversionCache(str(tmp_path / "tts")))
+    tts.set_engine(engine)
+
+    def build(backs):
+        _write_cards(deck_path, backs)
+        return _guids(FankiModelDefault.import_deck(str(deck_path)).generate())
+
+    yield build
+
+    engine.shutdown()
+    tts.set_engine(None)
+
+
+def test_notes_of_a_legacy_package_keep_their_guid(build, tmp_path, monkeypatch):
+
+    # a package of the version that left GUIDs to genanki, which hashes the fields
+    with monkeypatch.context() as patch:
+        patch.setattr(FankiModelDefault, "_note_guid", lambda self, occurrences, key, fields: genanki.guid_for(*fields))
+        legacy = build(["un", "deux"])
+    shutil.rmtree(tmp_path / "temp" / "test.guids")
+
+    assert build(["un", "deux"]) == legacy
+
+    # edited and added notes: the first keeps its GUID, the new one is keyed
+    guids = build(["un !", "deux", "trois"])
+    assert guids["mot 0"] == legacy["mot 0"] and guids["mot 1"] == legacy["mot 1"]
+    assert guids["mot 2"] == genanki.guid_for(1234, "mot 2")
+
+
+def test_keyed_guids_without_a_legacy_package(build):
+
+    guids = build(["un", "deux"])
+
+    assert guids == {"mot 0": genanki.guid_for(1234, "mot 0"), "mot 1": genanki.guid_for(1234, "mot 1")}
+    assert build(["un !", "deux"]) == guids
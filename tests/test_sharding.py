@@ -0,0 +1,49 @@
+import json
+import os
+
+import genanki
+import pytest
+
+from anki.sharding import ShardedPackageWriter, ShardPolicy
+
+MODEL = genanki.Model(1607392319, 'Test', fields=[{'name': 'front'}, {'name': 'group'}],
+                      templates=[{'name': 'Card 1', 'qfmt': '{{front}}', 'afmt': '{{group}}'}])
+
+
+def _write(tmp_path, policy, groups):
+
+    index_path = str(tmp_path / "deck.shards.json")
+    writer = ShardedPackageWriter(index_path, 1234, "Deck", MODEL, policy)
+    for number, group in enumerate(groups):
+        writer.add_note(genanki.Note(model=MODEL, fields=[f"card {number}", group], guid=f"guid{number}"))
+    writer.close()
+
+    with open(index_path) as file:
+        return json.load(file)
+
+
+def test_cards_policy_fills_shards_in_order(tmp_path):
+
+    index = _write(tmp_path, ShardPolicy(cards=2), ["a"] * 5)
+
+    assert [shard['notes'] for shard in index['shards']] == [2, 2, 1]
+    assert [shard['deck'][1] for shard in index['shards']] == ["Deck::Part 1", "Deck::Part 2", "Deck::Part 3"]
+    assert all(os.path.isfile(tmp_path / shard['file']) for shard in index['shards'])
+
+
+def test_field_policy_caps_the_open_shards(tmp_path):
+
+    index = _write(tmp_path, ShardPolicy(field='group', max_open=2), ["a", "b", "a", "c", "b", "a"])
+
+    # the least recently used value is finished for c, then for b and a
+    # coming back, which get a second part of their subdeck
+    assert [(shard['deck'][1], shard['notes']) for shard in index['shards']] == [
+        ("Deck::a", 2), ("Deck::b", 1), ("Deck::c", 1), ("Deck::b", 1), ("Deck::a", 1)]
+    assert index['shards'][1]['deck'][0] == index['shards'][3]['deck'][0]
+    assert index['notes'] == {"guid0": 1, "guid1": 2, "guid2": 1, "guid3": 3, "guid4": 4, "guid5": 5}
+
+
+def test_field_policy_rejects_unknown_fields(tmp_path):
+
+    with pytest.raises(ValueError):
+        ShardedPackageWriter(str(tmp_path / "deck.shards.json"), 1234, "Deck", MODEL, ShardPolicy(field='back'))
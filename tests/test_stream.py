@@ -0,0 +1,30 @@
+import inspect
+import io
+import json
+
+import pytest
+
+from anki.stream import JsonStreamReader
+
+DOCUMENT = ('{"a": 1.5e-07, "b": [2.0E+5, 3], "id": -12, "name": "Numbers",'
+            ' "cards": [{"front": "un", "weight": 0.25}, {"front": "deux", "weight": 1E3, "tags": [true, null]}]}')
+
+
+def _read(document, chunk_size) -> dict:
+
+    values = {}
+    for key, value in JsonStreamReader(io.StringIO(document), chunk_size).items():
+        # arrays come out as generators over their items
+        values[key] = list(value) if inspect.isgenerator(value) else value
+    return values
+
+
+@pytest.mark.parametrize("chunk_size", range(1, len(DOCUMENT) + 1))
+def test_every_chunk_size_reads_the_same_values(chunk_size):
+    assert _read(DOCUMENT, chunk_size) == json.loads(DOCUMENT)
+
+
+def test_truncated_document_fails():
+
+    with pytest.raises(ValueError):
+        _read(DOCUMENT[:40], 8)
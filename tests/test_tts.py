@@ -0,0 +1,119 @@
+import os
+import time
+
+import pytest
+
+from anki.cache import ConversionCache
+from anki.ffmpeg import ffmpeg_executable
+from anki.tts import StubBackend, TtsEngine, marked_ssml, split_marked_audio
+
+
+def _has_ffmpeg() -> bool:
+    try:
+        ffmpeg_executable()
+        return True
+    except FileNotFoundError:
+        return False
+
+
+@pytest.fixture
+def engine_factory(tmp_path):
+
+    engines = []
+
+    def factory(**options):
+        engine = TtsEngine(cache=ConversionCache(str(tmp_path / "tts")), **options)
+        engines.append(engine)
+        return engine
+
+    yield factory
+    for engine in engines:
+        engine.shutdown()
+
+
+def test_identical_requests_in_flight_share_one_call(engine_factory):
+
+    backend = StubBackend(latency=0.2)
+    engine = engine_factory(backend=backend)
+
+    first = engine.submit("Une chaise")
+    second = engine.submit("Une chaise")
+
+    assert first is second
+    assert os.path.isfile(first.result())
+    assert backend.calls == [("Une chaise", 'fr', False)]
+
+
+def test_cached_clips_are_not_synthesised_again(engine_factory):
+
+    backend = StubBackend()
+    engine = engine_factory(backend=backend)
+
+    path = engine.synthesize("Une table", prosody='slow')
+
+    assert engine.cached("Une table", prosody='slow') == path
+    assert engine.synthesize("Une table", prosody='slow') == path
+    assert engine.synthesize("Une  table ", prosody='slow') == path
+    assert len(backend.calls) == 1
+
+
+def test_stub_backend_is_not_rate_limited_by_default(engine_factory):
+
+    engine = engine_factory(backend=StubBackend())
+
+    started = time.monotonic()
+    for future in [engine.submit(f"mot {number}") for number in range(40)]:
+        future.result()
+
+    # 40 requests at Polly's 8 per second would take several seconds
+    assert time.monotonic() - started < 2
+
+
+def test_marked_ssml_marks_each_text_in_order():
+
+    ssml = marked_ssml(["Tom & Jerry", "a < b"], prosody='slow', gap_ms=200)
+
+    assert ssml == ('<speak><prosody rate="slow">'
+                    '<mark name="0"/>Tom &amp; Jerry<break time="200ms"/>'
+                    '<mark name="1"/>a &lt; b<break time="200ms"/>'
+                    '</prosody></speak>')
+
+
+def test_split_marked_audio_cuts_one_clip_per_text_in_order():
+
+    # 1 kHz, so a millisecond is one 16-bit sample; each text is filled
+    # with its own byte value and followed by 300 ms of silence
+    durations = [100, 250, 40]
+    pcm = bytearray()
+    marks = []
+    for index, duration in enumerate(durations):
+        marks.append((str(index), len(pcm) // 2))
+        pcm += bytes([index + 1]) * (2 * duration) + bytes(2 * 300)
+
+    clips = split_marked_audio(bytes(pcm), 1000, list(reversed(marks)), len(durations), gap_ms=300)
+
+    assert len(clips) == len(durations)
+    for index, (clip, duration) in enumerate(zip(clips, durations)):
+        # the text and half of the pause after it
+        assert clip == bytes([index + 1]) * (2 * duration) + bytes(2 * 150)
+
+
+def test_split_marked_audio_needs_every_mark():
+
+    with pytest.raises(ValueError):
+        split_marked_audio(bytes(4000), 1000, [("0", 0), ("2", 1000)], 3)
+
+
+@pytest.mark.skipif(not _has_ffmpeg(), reason="ffmpeg is needed to encode the clips")
+def test_batched_requests_make_one_call_and_one_clip_per_text(engine_factory):
+
+    backend = StubBackend()
+    engine = engine_factory(backend=backend, batch_size=3, batch_linger=1)
+    texts = ["Une chaise", "Une table", "Un tableau"]
+
+    paths = [future.result() for future in [engine.submit(text) for text in texts]]
+
+    assert backend.calls == [(tuple(texts), 'fr', False)]
+    assert len(set(paths)) == len(texts)
+    assert all(os.path.getsize(path) > 0 for path in paths)
+    assert [engine.cached(text) for text in texts] == paths
@@ -0,0 +1,23 @@
+from anki.watch import DeckWatcher
+
+
+def test_snapshot_walks_nested_asset_folders(tmp_path):
+
+    (tmp_path / "data.json").write_text("{}")
+    (tmp_path / "assets" / "images" / ".cache").mkdir(parents=True)
+    (tmp_path / "assets" / "01_une_chaise.jpg").write_text("x")
+    (tmp_path / "assets" / "images" / "02_une_table.jpg").write_text("x")
+    (tmp_path / "assets" / "images" / "03_un_livre.jpg.tmp").write_text("x")
+    (tmp_path / "assets" / "images" / ".cache" / "thumbnail").write_text("x")
+
+    before = DeckWatcher.snapshot(str(tmp_path))
+    assert sorted(before) == ["assets/01_une_chaise.jpg", "assets/images/02_une_table.jpg", "data.json"]
+
+    (tmp_path / "assets" / "images" / "02_une_table.jpg").write_text("changed")
+    (tmp_path / "assets" / "images" / "04_un_stylo.jpg").write_text("x")
+
+    assert DeckWatcher.diff(before, DeckWatcher.snapshot(str(tmp_path))) == {
+        'added': ["assets/images/04_un_stylo.jpg"],
+        'modified': ["assets/images/02_une_table.jpg"],
+        'removed': [],
+    }
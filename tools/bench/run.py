@@ -0,0 +1,238 @@
+import os
+import io
+import sys
+import json
+import time
+import glob
+import argparse
+import platform
+import statistics
+import contextlib
+from importlib import metadata
+
+try:
+    import resource
+except ImportError:
+    # Windows, where the CPU time of ffmpeg and the other children isn't reported
+    resource = None
+
+bench_directory = os.path.dirname(os.path.abspath(__file__))
+root_directory = os.path.dirname(os.path.dirname(bench_directory))
+sys.path.insert(0, root_directory)
+sys.path.insert(0, bench_directory)
+
+from synthetic import generate_deck
+
+PACKAGES = ["genanki", "pillow", "imageio-ffmpeg", "boto3", "beautifulsoup4"]
+
+
+def children_cpu_time():
+    """
+    User and system time of the finished child processes, ffmpeg and the
+    process pool workers once the pool is shut down.
+    """
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def measure(function, repeat):
+    """
+    Runs `function` `repeat` times and returns wall and CPU timings. `cpu`
+    includes the children, which `cpu_children` reports on its own.
+    """
+    wall, cpu, cpu_children = [], [], []
+    result = None
+    for _ in range(repeat):
+        wall_start, cpu_start, children_start = time.perf_counter(), time.process_time(), children_cpu_time()
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = function()
+        wall.append(time.perf_counter() - wall_start)
+        cpu_children.append(children_cpu_time() - children_start)
+        cpu.append(time.process_time() - cpu_start + cpu_children[-1])
+
+    return {"median": statistics.median(wall), "min": min(wall), "max": max(wall), "cpu": statistics.median(cpu),
+            "cpu_children": statistics.median(cpu_children), "runs": repeat}, result
+
+
+def versions():
+    found = {}
+    for package in PACKAGES:
+        try:
+            found[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            found[package] = None
+    return found
+
+
+def bench_converters(deck_path, scratch_path, repeat):
+    """
+    Times each encoder on the deck's first asset of the matching kind,
+    outside of the conversion cache.
+    """
+    from anki import fanki
+
+    converters = [
+        ("convert_webp", "image_*.jpg", fanki._encode_webp, ".webp"),
+        ("convert_ogg", "audio_*.mp3", fanki._encode_ogg, ".ogg"),
+        ("convert_mp4", "video_*.mov", fanki._encode_mp4, ".mp4"),
+    ]
+
+    results = {}
+    for stage, pattern, encoder, extension in converters:
+        sources = sorted(glob.glob(os.path.join(deck_path, "assets", pattern)))
+        if not sources:
+            continue
+
+        destination = os.path.join(scratch_path, "converted" + extension)
+        timing, _ = measure(lambda: encoder(sources[0], destination), repeat)
+        timing["bytes_in"] = os.path.getsize(sources[0])
+        timing["bytes_out"] = os.path.getsize(destination)
+        results[stage] = timing
+
+    return results
+
+
+def run(args):
+    from anki import tts
+    from anki.fanki import FankiModelDefault
+
+    class SyntheticDeck(FankiModelDefault):
+        # the default model has no video field, synthetic decks put theirs in back_video
+
+        def _setup(self):
+            super()._setup()
+            self._f_model.add_field('back_video')
+
+        def _card_from_data(self, card) -> dict:
+            return {**super()._card_from_data(card), 'back_video': card.get('back_video')}
+
+    # the conversion cache would turn every repeat after the first into a lookup
+    if not args.cache:
+        os.environ["FANKI_CACHE"] = "0"
+
+    tts.set_engine(tts.TtsEngine(backend=tts.StubBackend(latency=args.tts_latency), concurrency=args.tts_concurrency, rate=0, batch_size=args.tts_batch))
+
+    deck_path = os.path.join(root_directory, "temp", "bench", f"synthetic_{args.cards}")
+    scratch_path = os.path.join(root_directory, "temp", "bench", "scratch")
+    os.makedirs(scratch_path, exist_ok=True)
+
+    generate_deck(deck_path, cards=args.cards, images=args.images, audio=args.audio, video=args.video, html=args.html,
+                  tts=args.tts, unique_assets=args.unique_assets, seed=args.seed)
+
+    def clear_tts():
+        for file_path in glob.glob(os.path.join(deck_path, "assets", "tts_*.ogg")):
+            os.remove(file_path)
+
+    stages = {}
+
+    stages["import_deck"], _ = measure(lambda: SyntheticDeck.import_deck(deck_path), args.repeat)
+
+    def parse_fields():
+        clear_tts()
+        deck = SyntheticDeck.import_deck(deck_path)
+        return sum(1 for _ in deck._parse_cards(args.jobs))
+
+    stages["parse_fields"], _ = measure(parse_fields, args.repeat)
+    stages.update(bench_converters(deck_path, scratch_path, args.repeat))
+
+    def build_genanki_deck():
+        deck = SyntheticDeck.import_deck(deck_path)
+        return deck._get_deck_instance(args.jobs), deck
+
+    _, (genanki_deck, deck) = measure(build_genanki_deck, 1)
+
+    # genanki only packages files, so media held in memory (the default
+    # without the cache) is written to the scratch folder first, untimed
+    media_path = os.path.join(scratch_path, "media")
+    os.makedirs(media_path, exist_ok=True)
+    media_files = {}
+    for item in deck._deck_media:
+        item = item.restored()
+        if item.name in media_files:
+            continue
+        if item.data is not None:
+            media_files[item.name] = os.path.join(media_path, item.name)
+            with open(media_files[item.name], "wb") as file:
+                file.write(item.data)
+        else:
+            media_files[item.name] = item.path
+
+    def write_package():
+        import genanki
+
+        package = genanki.Package(genanki_deck)
+        package.media_files = list(media_files.values())
+        package.write_to_file(os.path.join(scratch_path, "package.apkg"))
+
+    stages["package_write_to_file"], _ = measure(write_package, args.repeat)
+
+    def generate():
+        clear_tts()
+        return SyntheticDeck.import_deck(deck_path).generate(jobs=args.jobs, force=True)
+
+    stages["generate"], package_path = measure(generate, args.repeat)
+    stages["generate"]["bytes_out"] = os.path.getsize(package_path)
+    os.remove(package_path)
+
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "packages": versions(),
+        "config": vars(args),
+        "stages": stages,
+    }
+
+
+def compare(baseline_path, results):
+    with open(baseline_path, "r") as file:
+        baseline = json.load(file)
+
+    print(f"\n{'Stage':<24} {'Baseline':>10} {'Current':>10} {'Change':>8}")
+    for stage, timing in results["stages"].items():
+        before = baseline.get("stages", {}).get(stage)
+        if before is None:
+            continue
+        change = (timing["median"] - before["median"]) / before["median"] * 100 if before["median"] else 0
+        print(f"{stage:<24} {before['median']:>9.3f}s {timing['median']:>9.3f}s {change:>+7.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the import_deck -> generate path on a synthetic deck.")
+    parser.add_argument("--cards", type=int, default=200)
+    parser.add_argument("--images", type=float, default=0.5)
+    parser.add_argument("--audio", type=float, default=0.3)
+    parser.add_argument("--video", type=float, default=0.0)
+    parser.add_argument("--html", type=float, default=0.2)
+    parser.add_argument("--tts", type=float, default=0.5)
+    parser.add_argument("--unique-assets", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--jobs", type=int, default=1)
+    parser.add_argument("--cache", action="store_true", help="keep the conversion cache enabled")
+    parser.add_argument("--tts-latency", type=float, default=0.0, help="seconds the stub TTS backend sleeps per request")
+    parser.add_argument("--tts-concurrency", type=int, default=8)
+    parser.add_argument("--tts-batch", type=int, default=1, help="texts per stub TTS request, cut apart at SSML marks")
+    parser.add_argument("--output", metavar="PATH", help="write the results as JSON to PATH")
+    parser.add_argument("--compare", metavar="PATH", help="print the change against a previous JSON result")
+    args = parser.parse_args()
+
+    results = run(args)
+
+    print(f"{'Stage':<24} {'Median':>10} {'CPU':>10}")
+    for stage, timing in results["stages"].items():
+        print(f"{stage:<24} {timing['median']:>9.3f}s {timing['cpu']:>9.3f}s")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if args.compare:
+        compare(args.compare, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+root_directory = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+STATEMENT = "from anki.fanki import FankiModelDefault"
+HEAVY_MODULES = ["genanki", "PIL", "bs4", "boto3"]
+
+
+def time_import(statement):
+    """
+    Runs `statement` in a fresh interpreter and returns the wall time of the
+    import, measured inside the child so interpreter startup is excluded.
+    """
+    code = (
+        "import sys, time, json\n"
+        "start = time.perf_counter()\n"
+        f"{statement}\n"
+        "elapsed = time.perf_counter() - start\n"
+        f"print(json.dumps({{'elapsed': elapsed, 'loaded': [m for m in {HEAVY_MODULES!r} if m in sys.modules]}}))\n"
+    )
+    output = subprocess.run([sys.executable, "-c", code], cwd=root_directory, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the time to import anki.fanki.")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--statement", default=STATEMENT)
+    parser.add_argument("--json", metavar="PATH", help="write the results to PATH")
+    args = parser.parse_args()
+
+    results = [time_import(args.statement) for _ in range(args.runs)]
+    timings = [result["elapsed"] for result in results]
+
+    report = {
+        "statement": args.statement,
+        "runs": args.runs,
+        "median": statistics.median(timings),
+        "min": min(timings),
+        "max": max(timings),
+        "loaded": results[-1]["loaded"],
+    }
+
+    print(f"{args.statement}")
+    print(f"  median {report['median'] * 1000:.1f} ms, min {report['min'] * 1000:.1f} ms, max {report['max'] * 1000:.1f} ms over {args.runs} runs")
+    print(f"  heavy modules loaded: {', '.join(report['loaded']) or 'none'}")
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
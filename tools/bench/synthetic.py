@@ -0,0 +1,129 @@
+import os
+import sys
+import json
+import random
+import shutil
+import argparse
+import subprocess
+
+root_directory = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+WORDS = ["chaise", "table", "tableau", "ordinateur", "tablette", "cahier", "livre", "stylo", "crayon", "fenêtre",
+         "porte", "lampe", "sac", "gomme", "règle", "carte", "horloge", "bureau", "classe", "école"]
+
+
+def find_ffmpeg():
+    """
+    Returns an ffmpeg executable, or None when neither the system one nor
+    the imageio-ffmpeg binary is available.
+    """
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is not None:
+        return ffmpeg
+
+    try:
+        import imageio_ffmpeg
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except (ImportError, RuntimeError):
+        return None
+
+
+def make_image(file_path, size, seed):
+    from PIL import Image, ImageDraw
+
+    rng = random.Random(seed)
+    image = Image.new("RGB", size, tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(40):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        draw.ellipse((x, y, x + rng.randrange(20, 200), y + rng.randrange(20, 200)), fill=tuple(rng.randrange(256) for _ in range(3)))
+    image.save(file_path, "JPEG", quality=90)
+
+
+def make_audio(ffmpeg, file_path, seconds, seed):
+    subprocess.run([ffmpeg, "-y", "-loglevel", "error", "-f", "lavfi", "-i", f"sine=frequency={220 + seed % 660}:duration={seconds}",
+                    "-ac", "1", file_path], check=True)
+
+
+def make_video(ffmpeg, file_path, seconds):
+    subprocess.run([ffmpeg, "-y", "-loglevel", "error", "-f", "lavfi", "-i", f"testsrc=duration={seconds}:size=640x360:rate=25",
+                    "-f", "lavfi", "-i", f"sine=duration={seconds}", "-shortest", file_path], check=True)
+
+
+def generate_deck(deck_path, cards=100, images=0.5, audio=0.3, video=0.0, html=0.2, tts=0.5, unique_assets=20,
+                  image_size=(1600, 1200), seed=1):
+    """
+    Writes a deck directory (data.json plus assets/) with `cards` cards. The
+    ratios give the share of cards with an image, an MP3, a video, an HTML
+    back field and a `_tts` sentence. Assets are drawn from a pool of
+    `unique_assets` files per kind, so decks also exercise repeated media.
+    Videos go in `back_video`, which FankiModelDefault doesn't have; run.py
+    builds the deck with a model that adds it.
+    """
+    rng = random.Random(seed)
+    assets_path = os.path.join(deck_path, "assets")
+    os.makedirs(assets_path, exist_ok=True)
+
+    ffmpeg = find_ffmpeg()
+    if ffmpeg is None and (audio or video):
+        print("ffmpeg not found, generating the deck without audio and video", file=sys.stderr)
+        audio = video = 0
+
+    def asset(kind, index, extension, maker):
+        file_name = f"{kind}_{index:04d}{extension}"
+        file_path = os.path.join(assets_path, file_name)
+        if not os.path.isfile(file_path):
+            maker(file_path)
+        return f"assets/{file_name}"
+
+    deck_cards = []
+    for index in range(cards):
+        word = f"{rng.choice(WORDS)} {index}"
+        card = {"front": word, "back": word.title()}
+
+        if rng.random() < images:
+            n = rng.randrange(unique_assets)
+            card["front_image"] = asset("image", n, ".jpg", lambda path: make_image(path, image_size, seed * 1000 + n))
+
+        if rng.random() < audio:
+            n = rng.randrange(unique_assets)
+            card["back_audio"] = asset("audio", n, ".mp3", lambda path: make_audio(ffmpeg, path, 2, n))
+
+        if rng.random() < video:
+            n = rng.randrange(unique_assets)
+            card["back_video"] = asset("video", n, ".mov", lambda path: make_video(ffmpeg, path, 3))
+
+        if rng.random() < html:
+            card["back"] = f"<b>{word.title()}</b> <i>({index})</i>"
+
+        if rng.random() < tts:
+            card["back_sentence"] = f"Voici {word}, phrase numéro {index}."
+            card["back_sentence_tts"] = True
+
+        deck_cards.append(card)
+
+    with open(os.path.join(deck_path, "data.json"), "w") as file:
+        json.dump({"id": 1000000000 + seed, "name": f"Bench::Synthetic {cards}", "cards": deck_cards}, file, ensure_ascii=False, indent=1)
+
+    return deck_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic deck directory for benchmarks.")
+    parser.add_argument("path", help="deck directory to create (<namespace>/<alias>)")
+    parser.add_argument("--cards", type=int, default=100)
+    parser.add_argument("--images", type=float, default=0.5)
+    parser.add_argument("--audio", type=float, default=0.3)
+    parser.add_argument("--video", type=float, default=0.0)
+    parser.add_argument("--html", type=float, default=0.2)
+    parser.add_argument("--tts", type=float, default=0.5)
+    parser.add_argument("--unique-assets", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    generate_deck(args.path, cards=args.cards, images=args.images, audio=args.audio, video=args.video, html=args.html,
+                  tts=args.tts, unique_assets=args.unique_assets, seed=args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,76 @@
 import os
 import re
 import json
+import hashlib
+import argparse
+import functools
+from concurrent.futures import ProcessPoolExecutor
 from unidecode import unidecode
 from PIL import Image, ImageDraw, ImageFont, ImageOps
 
 current_directory = os.path.dirname(__file__)
 
-def create_image_with_text_webp(name=None, color = None, alias = None, create_question = True):
+FONT_PATH = "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"
+FONT_SIZE = 24
+# Size of the image from the original example
+IMAGE_SIZE = (400, 100)
+BORDER_SIZE = 10  # Change this to adjust the size of the border
+QUESTION = "Quelle Couleur ?"
 
-    if name is None:
-        raise ValueError("name must be specified")
+# records the render key of every image written, so unchanged ones are skipped
+INDEX_FILE_NAME = ".img_colors.json"
 
-    name = name.title()
 
-    if color is None:
-        raise ValueError("color_hex and must be specified")
+def default_output_path():
+    return os.path.join(os.path.dirname(os.path.dirname(current_directory)), "temp")
 
-    if alias is None:
-        alias = name
+
+def make_alias(name):
 
     # create from name. no spaces, lowercase, no accents
-    alias = alias.replace(" ", "_").lower()
+    alias = name.replace(" ", "_").lower()
     # remove accents. á -> a. é -> e. etc all special characters..
     alias = unidecode(alias)
     # remove special characters. avoid double __
-    alias = re.sub(r'\W+', '', alias)
+    return re.sub(r'\W+', '', alias)
+
+
+@functools.lru_cache(maxsize=None)
+def _font(font_path, font_size):
+    return ImageFont.truetype(font_path, font_size)
+
+
+@functools.lru_cache(maxsize=None)
+def _font_digest(font_path):
+    with open(font_path, 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+@functools.lru_cache(maxsize=4096)
+def _text_position(text, font_path, font_size, image_size):
+    """
+    Where ``text`` is drawn to be centred; the layout only depends on the
+    text, the font and the size, so every colour with the same label shares it.
+    """
+
+    draw = ImageDraw.Draw(Image.new('RGB', (1, 1)))
+    text_bbox = draw.textbbox((0, 0), text, font=_font(font_path, font_size))
+    text_x = (image_size[0] - (text_bbox[2] - text_bbox[0])) / 2
+    text_y = (image_size[1] - (text_bbox[3] - text_bbox[1])) / 2
+    return text_x, text_y
+
+
+def render_key(name, color, image_size=IMAGE_SIZE, font_path=FONT_PATH, font_size=FONT_SIZE, border_size=BORDER_SIZE):
+    """
+    Content hash of everything an image depends on: the label, the colour,
+    the size, the border and the font file itself.
+    """
+
+    payload = json.dumps([name, color.lower(), list(image_size), border_size, _font_digest(font_path), font_size])
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def render_image(name, color, filepath, image_size=IMAGE_SIZE, font_path=FONT_PATH, font_size=FONT_SIZE, border_size=BORDER_SIZE):
 
     # Convert the color from hex to RGB
     color_rgb = tuple(int(color[i:i + 2], 16) for i in (1, 3, 5))
@@ -35,42 +81,136 @@ def create_image_with_text_webp(name=None, color = None, alias = None, create_qu
     # Choose the text color based on the luminance
     text_color = "black" if luminance > 0.5 else "white"
 
-
-    # Size of the image from the original example
-    image_size = (400, 100)
     # Create a new image with the specified color
     image = Image.new('RGB', image_size, color)
-    # Get a font
-    font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 24)
     # Get a drawing context
     draw = ImageDraw.Draw(image)
-    # Draw the text in the middle of the rectangle, in black
-    text_bbox = draw.textbbox((0, 0), name, font=font)
-    text_x = (image_size[0] - (text_bbox[2] - text_bbox[0])) / 2
-    text_y = (image_size[1] - (text_bbox[3] - text_bbox[1])) / 2
-    draw.text((text_x, text_y), name, font=font, fill=text_color)
+    # Draw the text in the middle of the rectangle
+    draw.text(_text_position(name, font_path, font_size, tuple(image_size)), name, font=_font(font_path, font_size), fill=text_color)
 
-    border_size = 10  # Change this to adjust the size of the border
     image = ImageOps.expand(image, border=border_size, fill='white')
 
     # Save the image to a file with .webp extension
-    image_tmp_path = os.path.dirname(os.path.dirname(current_directory))
-    filepath = os.path.join(image_tmp_path, "temp", f'{alias}.webp')
+    tmp_path = f"{filepath}.{os.getpid()}.tmp"
+    image.save(tmp_path, 'WEBP')
+    os.replace(tmp_path, filepath)
+    return filepath
+
+
+def create_image_with_text_webp(name=None, color = None, alias = None, create_question = True):
+
+    if name is None:
+        raise ValueError("name must be specified")
+
+    name = name.title()
+
+    if color is None:
+        raise ValueError("color_hex and must be specified")
+
+    if alias is None:
+        alias = name
+
+    alias = make_alias(alias)
+
+    filepath = os.path.join(default_output_path(), f'{alias}.webp')
     print("Saving image to ", filepath)
-    image.save(filepath, 'WEBP')
+    render_image(name, color, filepath)
 
     if create_question:
-        create_image_with_text_webp(name="Quelle Couleur ?", color=color, alias=f"{alias}.q", create_question=False)
+        create_image_with_text_webp(name=QUESTION, color=color, alias=f"{alias}.q", create_question=False)
 
     return filepath
 
 
-# Call the updated function
+def _load_index(output_path):
+
+    index_path = os.path.join(output_path, INDEX_FILE_NAME)
+    if not os.path.isfile(index_path):
+        return {}
+
+    try:
+        with open(index_path, 'r') as file:
+            return json.load(file)
+    except ValueError:
+        return {}
+
+
+def _save_index(output_path, index):
+
+    index_path = os.path.join(output_path, INDEX_FILE_NAME)
+    with open(index_path + ".tmp", 'w') as file:
+        json.dump(index, file, indent=1, sort_keys=True)
+    os.replace(index_path + ".tmp", index_path)
+
+
+def _render_job(job):
+    name, color, filepath = job
+    return render_image(name, color, filepath)
+
+
+def render_batch(images, output_path=None, jobs=None, force=False):
+    """
+    Renders ``images``, a list of ``(name, color, alias)``, into
+    ``output_path`` on a process pool. An image is skipped when its file
+    exists and was rendered from the same label, colour, size and font.
+    Returns the number of images rendered and skipped.
+    """
+
+    if output_path is None:
+        output_path = default_output_path()
+    os.makedirs(output_path, exist_ok=True)
+
+    index = {} if force else _load_index(output_path)
+
+    pending = []
+    keys = {}
+    for name, color, alias in images:
+        file_name = f"{make_alias(alias)}.webp"
+        keys[file_name] = render_key(name, color)
+        if index.get(file_name) == keys[file_name] and os.path.isfile(os.path.join(output_path, file_name)):
+            continue
+        pending.append((name, color, os.path.join(output_path, file_name)))
+
+    if pending:
+        if jobs is None or jobs > 1:
+            # chunks amortise the round-trips, each worker keeps its own font cache
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                chunksize = max(1, len(pending) // ((jobs or os.cpu_count() or 1) * 4))
+                for filepath in pool.map(_render_job, pending, chunksize=chunksize):
+                    print("Saving image to ", filepath)
+        else:
+            for filepath in map(_render_job, pending):
+                print("Saving image to ", filepath)
+
+    index.update(keys)
+    _save_index(output_path, index)
+
+    return len(pending), len(images) - len(pending)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Render the colour swatches of colors.json.")
+    parser.add_argument("--output", metavar="DIR", help="where the images are written (temp/ by default)")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="worker processes")
+    parser.add_argument("--force", action="store_true", help="render every image, even the unchanged ones")
+    parser.add_argument("--labels", action="store_true", help="also render each colour with its name and its question image as <alias>.q")
+    args = parser.parse_args()
+
+    with open(os.path.join(current_directory, 'colors.json'), 'r') as f:
+        colors = json.load(f)
+
+    images = []
+    for color_dict in colors:
+        if args.labels:
+            images.append((color_dict["name"].title(), color_dict["code"], color_dict["name"]))
+            images.append((QUESTION, color_dict["code"], f"{make_alias(color_dict['name'])}.q"))
+        else:
+            images.append((QUESTION, color_dict["code"], color_dict["name"]))
 
-with open(os.path.join(current_directory, 'colors.json'), 'r') as f:
-    colors = json.load(f)
+    rendered, skipped = render_batch(images, args.output, max(1, args.jobs), args.force)
+    print(f"{rendered} images rendered, {skipped} unchanged")
 
-# Now you can use the colors list as before
-for color_dict in colors:
 
-    create_image_with_text_webp(name="Quelle Couleur ?", alias=color_dict["name"], color=color_dict["code"], create_question=False)
+if __name__ == "__main__":
+    main()